@@ -19,20 +19,17 @@ def main():
     # Replace 'your_image_directory' with the path to your image folder
     image_dir = 'testing/collected'
 
-    frame_source = source_images_from_files.FilesFrameSource(directory=image_dir, glob='*.jp*')
+    # Scale both width and height, the decoder does most of it
+    scale_factor = 0.25
+
+    frame_source = source_images_from_files.FilesFrameSource(directory=image_dir, glob='*.jp*',
+                                                             decode_scale=scale_factor)
 
     # Iterate through the image frames using the generator
     for i, frame_and_info in enumerate(frame_source.yield_opencv_image_frames()):
         frame, info = frame_and_info
         print(f"Processing frame {i+1} {info}: Shape {frame.shape}, Data Type {frame.dtype}")
 
-        # Scale both width and height
-        scale_factor = 0.25
-
-        if scale_factor != 1.0:
-            # Use cv2.INTER_AREA for downscaling for best quality
-            frame = cv2.resize(frame, None, fx=scale_factor, fy=scale_factor, interpolation=cv2.INTER_AREA)
-
         cv2.imshow("Frame", frame)
 
         diags = detector.process_frame(frame)
@@ -4,15 +4,16 @@ import configuration
 import custom_logging
 
 import logging
-import time
 
-from flask import Flask, render_template, Response
+from flask import Flask, jsonify, render_template
 
 import change_processor
 import distributor
-import motion_detectors
+import jpeg_cache
+import pacing
+import pipeline
 import source_images
-import utilities
+import streaming
 
 configuration.configure()
 app = Flask(__name__)
@@ -22,24 +23,39 @@ def source():
     logger = logging.getLogger("source")
     logger.setLevel(logging.INFO)
     input_args = configuration.settings.get('input', {})
-    delay = input_args.get('delay', 10)
     logger.info("Creating image source with %s", input_args)
     frame_source = source_images.fetch_frame_source(**input_args)
     logger.info("Image source created")
 
-    cp = change_processor.ChangeProcessor()
+    pipeline_args = dict(configuration.settings.get('pipeline', {}))
+    if pipeline_args.pop('enabled', False):
+        # capture, detection and annotation each get a thread of their own
+        global staged_pipeline
+        staged_pipeline = pipeline.Pipeline(frame_source, cp, pacer, **pipeline_args)
+        yield from staged_pipeline.results()
+        return
 
     for frame_and_info in frame_source.yield_opencv_image_frames():
         frame, info = frame_and_info
         logger.debug("got image %s", info)
-        mrt = cp.process_frame(frame, info)
+        if pacer.should_detect():
+            mrt = cp.process_frame(frame, info)
+        else:
+            mrt = cp.pass_through(frame, info)
         logger.debug("source yielding %s", mrt)
         yield mrt
-        time.sleep(delay)
+        pacer.wait()
 
 
+cp = change_processor.ChangeProcessor()
+# input.delay is the capture interval, processing time comes out of it
+pacer = pacing.FramePacer(configuration.settings.get('input', {}).get('delay', 10),
+                          **configuration.settings.get('pacing', {}))
+staged_pipeline = None
+
 logging.info("Creating distributor")
-image_distributor = distributor.Distributor(source=source)
+image_distributor = distributor.Distributor(source=source, timestamp=lambda mrt: mrt.timestamp,
+                                            **configuration.settings.get('distributor', {}))
 logging.info("Created distributor")
 
 
@@ -49,42 +65,36 @@ def index():
     return render_template('index.html')
 
 
-def video_feed_gen(receiver: distributor.Receiver):
-    """Video streaming generator function."""
-    yield b'--frame\r\n'
-    while True:
-        logging.debug("video_feed_gen waiting for mrt")
-        mrt: motion_detectors.MotionDetector1Result = receiver.get_last_result()
-        logging.debug("video_feed_gen received mrt %s %s", type(mrt), mrt)
-        frame_jpeg = utilities.make_jpeg_from_cv2(mrt.frame2, quality=95)
-        yield b'Content-Type: image/jpeg\r\n\r\n' + frame_jpeg + b'\r\n--frame\r\n'
-
-
 @app.route('/video_feed')
 def video_feed():
     """Video streaming route. Put this in the src attribute of an img tag."""
-    c = image_distributor.get_receiver()
-    logging.info("created %s", c)
-    return Response(video_feed_gen(c), mimetype='multipart/x-mixed-replace; boundary=frame')
-
-
-def diff_feed_gen(receiver: distributor.Receiver):
-    """Video streaming generator function."""
-    yield b'--frame\r\n'
-    while True:
-        logging.debug("video_feed_gen waiting for mrt")
-        mrt: motion_detectors.MotionDetector1Result = receiver.get_last_result()
-        logging.debug("video_feed_gen received mrt %s %s", type(mrt), mrt)
-        frame_jpeg = utilities.make_jpeg_from_cv2(mrt.threshold_after_erode)
-        yield b'Content-Type: image/jpeg\r\n\r\n' + frame_jpeg + b'\r\n--frame\r\n'
+    return streaming.feed(image_distributor, 'frame2', 95)
 
 
 @app.route('/diff_feed')
 def diff_feed():
     """Video streaming route. Put this in the src attribute of an img tag."""
-    c = image_distributor.get_receiver()
-    logging.info("created %s", c)
-    return Response(diff_feed_gen(c), mimetype='multipart/x-mixed-replace; boundary=frame')
+    # the change processor only keeps the threshold plane around while somebody is watching it
+    return streaming.feed(image_distributor, 'threshold_after_erode', 75, plane_consumers=cp)
+
+
+@app.route('/main_feed')
+def main_feed():
+    """The unmarked frames at full resolution, from the main stream of a dual-stream camera."""
+    # the same as a diff feed: the change processor only builds the plane while somebody is watching it
+    return streaming.feed(image_distributor, 'main', 95, plane_consumers=cp)
+
+
+@app.route('/stats')
+def stats():
+    """counters for keeping an eye on the pipeline"""
+    return jsonify({
+        'distributor': image_distributor.stats(),
+        'change_processor': cp.stats(),
+        'pacing': pacer.stats(),
+        'pipeline': staged_pipeline.stats() if staged_pipeline is not None else None,
+        'jpeg_cache': jpeg_cache.stats(),
+    })
 
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+import urllib.parse
+
+import jinja2
+
+import app
+import distributor
+import jpeg_cache
+import streaming
+
+logger = logging.getLogger("app_asyncio")
+logger.setLevel(logging.INFO)
+
+BOUNDARY = b'--frame\r\n'
+FEEDS = {
+    '/video_feed': ('frame2', 95),
+    '/diff_feed': ('threshold_after_erode', 75),
+    '/main_feed': ('main', 95),
+}
+
+
+class FrameNotifier:
+    """
+    Hands each frame from the Distributor thread to the event loop. Coroutines await the next frame on a
+    single future that is shared by all of them and replaced on every frame.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.sequence = 0
+        self.result = None
+        self.future = loop.create_future()
+
+    def publish(self, result):
+        """runs on the event loop"""
+        self.sequence += 1
+        self.result = result
+        future, self.future = self.future, self.loop.create_future()
+        future.set_result(None)
+
+    async def next(self, after: int):
+        """the newest (sequence, result), waiting for one newer than after"""
+        while self.sequence <= after:
+            await self.future
+        return self.sequence, self.result
+
+    def bridge(self, image_distributor: distributor.Distributor):
+        """
+        Body of the one thread that waits on the distributor for the whole event loop. Every client depends on
+        it, so its receiver is never dropped for being slow, and it starts over with a new one if anything fails.
+        """
+        while True:
+            receiver = image_distributor.get_receiver(droppable=False)
+            try:
+                while True:
+                    # the timeout keeps this thread registered as a client while the source is quiet
+                    result = receiver.get_last_result(timeout=image_distributor.event.stale_after / 2)
+                    if result is not None:
+                        self.loop.call_soon_threadsafe(self.publish, result)
+            except Exception:
+                logger.exception("frame bridge failed, starting again with a new receiver")
+                receiver.close()
+                time.sleep(1)
+
+
+class Server:
+    """the routes of app.py served from one event loop, so an idle or slow viewer costs a coroutine, not a thread"""
+    def __init__(self, notifier: FrameNotifier):
+        self.notifier = notifier
+        self.clients = 0
+        self.sent = 0
+        self.templates = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'), autoescape=True)
+
+    def url_for(self, endpoint: str, **kwargs):
+        return '/' + endpoint
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # headers are not used
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2:
+                return
+            method = parts[0]
+            path, _, query = parts[1].partition('?')
+            args = {key: values[0] for key, values in urllib.parse.parse_qs(query).items()}
+            logger.debug("%s %s", method, path)
+
+            if method != 'GET':
+                await self.respond(writer, 405, 'text/plain', b'method not allowed')
+            elif path == '/':
+                page = self.templates.get_template('index.html').render(url_for=self.url_for)
+                await self.respond(writer, 200, 'text/html; charset=utf-8', page.encode('utf-8'))
+            elif path == '/stats':
+                body = json.dumps(self.stats(), default=str).encode('utf-8')
+                await self.respond(writer, 200, 'application/json', body)
+            elif path in FEEDS:
+                try:
+                    options = streaming.FeedOptions.from_args(args, *FEEDS[path])
+                except ValueError as e:
+                    await self.respond(writer, 400, 'text/plain', str(e).encode('utf-8'))
+                else:
+                    await self.stream(writer, options)
+            else:
+                await self.respond(writer, 404, 'text/plain', b'not found')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, content_type: str, body: bytes):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+
+    async def stream(self, writer: asyncio.StreamWriter, options: streaming.FeedOptions):
+        """an MJPEG stream, a client that is slow to drain or rate limited skips straight to the newest frame"""
+        plane = options.plane
+        loop = asyncio.get_running_loop()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                     b'Cache-Control: no-cache\r\nConnection: close\r\n\r\n' + BOUNDARY)
+        if plane != 'frame2':
+            # the change processor only keeps the plane around while somebody is watching it
+            app.cp.add_plane_consumer(plane)
+        self.clients += 1
+        try:
+            sequence = 0
+            while True:
+                sequence, mrt = await self.notifier.next(sequence)
+                # encoded once per result and variant whichever client gets there first, off the event loop
+                frame_jpeg = await loop.run_in_executor(None, options.jpeg, mrt)
+                if frame_jpeg is None:
+                    continue
+                not_before = streaming.next_due(options)
+                writer.write(streaming.mjpeg_part(frame_jpeg))
+                await writer.drain()
+                self.sent += 1
+                if not_before is not None and not_before > time.time():
+                    await asyncio.sleep(not_before - time.time())
+        finally:
+            self.clients -= 1
+            if plane != 'frame2':
+                app.cp.remove_plane_consumer(plane)
+
+    def stats(self) -> dict:
+        return {
+            'asyncio': {'clients': self.clients, 'sent': self.sent, 'sequence': self.notifier.sequence},
+            'distributor': app.image_distributor.stats(),
+            'change_processor': app.cp.stats(),
+            'pacing': app.pacer.stats(),
+            'pipeline': app.staged_pipeline.stats() if app.staged_pipeline is not None else None,
+            'jpeg_cache': jpeg_cache.stats(),
+        }
+
+
+async def serve(host: str, port: int):
+    loop = asyncio.get_running_loop()
+    notifier = FrameNotifier(loop)
+    threading.Thread(target=notifier.bridge, args=(app.image_distributor,), name="asyncio-bridge",
+                     daemon=True).start()
+    server = Server(notifier)
+    tcp_server = await asyncio.start_server(server.handle, host, port)
+    logger.info("serving on %s", ", ".join(str(s.getsockname()) for s in tcp_server.sockets))
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
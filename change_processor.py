@@ -1,14 +1,21 @@
+import atexit
+import collections
 import datetime
+import functools
 import json
 import logging
+import threading
 
 import cv2
 import numpy as np
 import piexif
 import piexif.helper
 
+import clip_writer
 import configuration
 import motion_detectors
+import pre_roll
+import saver
 import utilities
 
 from PIL import Image
@@ -18,19 +25,35 @@ logger.setLevel(logging.INFO)
 
 
 class ChangeProcessor:
-    def __init__(self):
-        motion_parameters = configuration.settings.get('motion', {})
-        self.motion_detector = motion_detectors.MotionDetector1(**motion_parameters)
-        self.hit_ratio = motion_parameters.get('hit_ratio', 0.001)
-
-        self.last_frame = None
-        self.last_timestamp = None
-        self.last_info_dict = None
+    def __init__(self, motion_parameters: dict = None, output_parameters: dict = None):
+        """motion_parameters and output_parameters default to the motion and output sections of the settings"""
+        if motion_parameters is None:
+            motion_parameters = configuration.settings.get('motion', {})
+        # what is left once ours are taken out is for the detector, which rejects anything it does not know
+        motion_parameters = dict(motion_parameters)
+        self.hit_ratio = motion_parameters.pop('hit_ratio', 0.001)
+        # size of the tiles used to screen out quiet frames before looking for contours, 0 turns screening off
+        self.tile_size = motion_parameters.pop('tile_size', 32)
+        self.motion_detector = motion_detectors.fetch_motion_detector(**motion_parameters)
 
         self.event_id = 1
         self.in_event = False
 
-        output_parameters = configuration.settings.get('output', {})
+        if output_parameters is None:
+            output_parameters = configuration.settings.get('output', {})
+        # frames from before an event starts, saved when it does
+        self.pre_roll = pre_roll.PreRollBuffer(max_frames=output_parameters.get('pre_roll_frames', 1),
+                                               max_seconds=output_parameters.get('pre_roll_seconds'),
+                                               max_bytes=output_parameters.get('pre_roll_bytes'),
+                                               quality=output_parameters.get('pre_roll_quality'),
+                                               scale=output_parameters.get('pre_roll_scale', 1.0))
+        # frames after an event ends that are still saved with it
+        self.post_roll_frames = output_parameters.get('post_roll_frames', 0)
+        self.post_roll_seconds = output_parameters.get('post_roll_seconds')
+        self.post_roll_event_id = None
+        self.post_roll_remaining = 0
+        self.post_roll_until = None
+
         self.output_directory = output_parameters.get('directory', 'output')
         self.save_delta = output_parameters.get('save_delta', False)
         self.save_eroded = output_parameters.get('save_eroded', False)
@@ -39,52 +62,122 @@ class ChangeProcessor:
         self.do_draw_contours = output_parameters.get('draw_contours', True)
         self.do_draw_boxes = output_parameters.get('draw_boxes', False)
 
+        # jpeg writes each saved frame as a file, clip writes each event as video with a metadata sidecar
+        self.output_format = output_parameters.get('format', 'jpeg')
+        if self.output_format not in ('jpeg', 'clip'):
+            raise ValueError(f"unknown output format '{self.output_format}'")
+        clip_parameters = output_parameters.get('clip', {})
+        self.clip_fourcc = clip_parameters.get('fourcc', 'mp4v')
+        self.clip_extension = clip_parameters.get('extension', '.mp4')
+        self.clip_fps = clip_parameters.get('fps', 10)
+        self.clip = None
+        # a clip has to be written in order, so it gets a single writer of its own
+        self.clip_saver = saver.AsyncSaver(workers=1, queue_size=clip_parameters.get('queue_size', 64),
+                                           name='clip-writer') if self.output_format == 'clip' else None
+
+        # files are encoded and written behind the frame loop, unless writer.workers is 0; clips have their own
+        writer_parameters = output_parameters.get('writer', {})
+        workers = writer_parameters.get('workers', 1)
+        if workers > 0 and self.output_format == 'jpeg':
+            self.saver = saver.AsyncSaver(workers=workers, queue_size=writer_parameters.get('queue_size', 16),
+                                          policy=writer_parameters.get('policy', 'block'))
+        else:
+            self.saver = None
+        atexit.register(self.close)
+
+        # detector planes that somebody downstream (e.g. a /diff_feed client) reads after process_frame returns
+        self.plane_consumers = collections.Counter()
+        self.plane_consumers_lock = threading.Lock()
+
+    def add_plane_consumer(self, name: str):
+        with self.plane_consumers_lock:
+            self.plane_consumers[name] += 1
+
+    def remove_plane_consumer(self, name: str):
+        with self.plane_consumers_lock:
+            self.plane_consumers[name] -= 1
+            if self.plane_consumers[name] <= 0:
+                del self.plane_consumers[name]
+
     def process_frame(self, frame, info):
+        return self.annotate(self.detect(frame, info), frame, info)
+
+    def planes_wanted(self) -> set:
+        """detector planes that annotate() or somebody after it will read"""
+        wanted = {'threshold_after_erode'}
+        if self.save_background:
+            wanted.add('background')
+        if self.save_delta:
+            wanted.add('frame_delta')
+        with self.plane_consumers_lock:
+            wanted.update(self.plane_consumers)
+        return wanted
+
+    def detect(self, frame, info, detach: bool = False):
+        """
+        The motion detection half of process_frame. With detach the result is safe to hand to annotate() after
+        the detector has moved on to later frames, as it is in a staged pipeline.
+        """
+        # TODO: make sure we have consistent frame sizes across frames
+        mrt = self.motion_detector.process_frame(frame)
+        if detach:
+            mrt.detach(keep=self.planes_wanted())
+        return mrt
+
+    def annotate(self, mrt, frame, info):
+        """the rest of process_frame: contours, markup, events and saving"""
         timestamp = info.get('timestamp')
         now = datetime.datetime.now(datetime.timezone.utc)
         if timestamp is None:
             timestamp = now
         info['processed'] = now.isoformat()
 
-        # TODO: make sure we have consistent frame sizes across frames
-        mrt = self.motion_detector.process_frame(frame)
-
-        frame2 = mrt.frame.copy()
+        mrt.timestamp = timestamp
+        mrt.set_main(info.pop('main', None))
+        # frame2 is only drawn on for the marked up saves; otherwise it is the frame, and shares its encodes
+        frame2 = mrt.frame.copy() if self.save_marked_up else mrt.frame
+        mrt.frame2 = frame2
 
         hit = False
         boxes = []
 
         if mrt.derived_data_is_valid:
-            shape = frame2.shape
-            total_area = shape[0] * shape[1]
+            # only peek at the mask, so it is not copied out of the detector unless somebody else wants it
+            t_frame = mrt.peek_plane('threshold_after_erode')
 
-            t_frame = mrt.threshold_after_erode
+            # ratios are worked out on the detection plane, they come out the same at any scale.
+            # pixels outside the motion zones do not count towards the area.
+            shape = t_frame.shape
+            total_area = mrt.active_area or shape[0] * shape[1]
 
-            contours, _ = cv2.findContours(t_frame, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            changed = cv2.countNonZero(t_frame)
+            mrt.thresholded_area_ratio = changed / total_area
+
+            contours = self.find_contours(mrt, t_frame, changed, total_area)
             mrt.contour_area_ratio = sum(cv2.contourArea(contour) for contour in contours) / total_area
-            max_value = np.iinfo(t_frame.dtype).max
-            mrt.thresholded_area_ratio = np.mean(mrt.threshold_after_erode) / max_value
 
             hit = mrt.contour_area_ratio > self.hit_ratio
 
+            contours = self.scale_contours(contours, mrt.scale)
+            if self.save_marked_up and self.do_draw_contours:
+                cv2.drawContours(frame2, contours, -1, (0, 255, 0), 1)
+
             for contour in contours:
                 (x, y, w, h) = cv2.boundingRect(contour)
                 boxes.append((x, y, w, h))
-                if self.save_marked_up:
-                    if self.do_draw_contours:
-                        cv2.drawContours(frame2, contours, -1, (0, 255, 0), 1)
-
-                    if hit and self.do_draw_boxes:
-                        cv2.rectangle(frame2, (x, y), (x + w, y + h), (255, 255, 0), 1)
+                if self.save_marked_up and hit and self.do_draw_boxes:
+                    cv2.rectangle(frame2, (x, y), (x + w, y + h), (255, 255, 0), 1)
         else:
             mrt.contour_area_ratio = 0
             mrt.thresholded_area_ratio = 0
 
         info_dict = {
             "source_info": info,
-            "contour_area_ratio": mrt.contour_area_ratio
+            "contour_area_ratio": mrt.contour_area_ratio,
+            "thresholded_area_ratio": mrt.thresholded_area_ratio,
         }
 
+        mrt.bounding_rects = boxes
         detailed_info_dict = {
             "boxes": boxes,
         }
@@ -99,25 +192,16 @@ class ChangeProcessor:
                                         bg_color_rgb=(128, 128, 128))
 
         if hit:
-            self.last_info_dict['event_id'] = info_dict['event_id'] = self.event_id
+            info_dict['event_id'] = self.event_id
             if not self.in_event:
                 logger.info("event %d is starting", self.event_id)
-                self.save_file(self.last_frame, self.last_timestamp, info_dict=self.last_info_dict)
-
-            self.save_file(frame, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict)
-            if self.save_background:
-                self.save_file(mrt.background, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict,
-                               suffix="-background")
-            if self.save_delta:
-                self.save_file(mrt.frame_delta, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict,
-                               suffix="-delta")
-            if self.save_eroded:
-                self.save_file(mrt.threshold_after_erode, timestamp, info_dict=info_dict,
-                               detailed_info_dict=detailed_info_dict,
-                               suffix="-eroded", one_bit=True)
-            if self.save_marked_up:
-                self.save_file(frame2, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict,
-                               suffix="-markedup")
+                self.post_roll_event_id = None
+                self.start_clip(timestamp, self.frame_to_save(mrt, frame).shape[1::-1])
+                for entry in self.pre_roll.drain():
+                    entry.info_dict['event_id'] = self.event_id
+                    self.save_file(entry.frame, entry.timestamp, info_dict=entry.info_dict, jpeg=entry.jpeg)
+
+            self.save_frames(frame, mrt, frame2, timestamp, info_dict, detailed_info_dict)
 
             self.in_event = True
         else:
@@ -125,34 +209,192 @@ class ChangeProcessor:
                 # event is ending
                 logger.info("event %d is ending", self.event_id)
 
-                self.save_file(frame, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict)
-                if self.save_background:
-                    self.save_file(mrt.background, timestamp, info_dict=info_dict,
-                                   detailed_info_dict=detailed_info_dict,
-                                   suffix="-background")
-                if self.save_delta:
-                    self.save_file(mrt.frame_delta, timestamp, info_dict=info_dict,
-                                   detailed_info_dict=detailed_info_dict,
-                                   suffix="-delta")
-                if self.save_eroded:
-                    self.save_file(mrt.threshold_after_erode, timestamp, info_dict=info_dict,
-                                   detailed_info_dict=detailed_info_dict,
-                                   suffix="-eroded", one_bit=True)
-                if self.save_marked_up:
-                    self.save_file(frame2, timestamp, info_dict=info_dict,
-                                   detailed_info_dict=detailed_info_dict, suffix="-markedup")
+                self.save_frames(frame, mrt, frame2, timestamp, info_dict, detailed_info_dict)
 
+                if self.post_roll_frames > 0 or self.post_roll_seconds is not None:
+                    self.post_roll_event_id = self.event_id
+                    self.post_roll_remaining = self.post_roll_frames
+                    if self.post_roll_seconds is not None:
+                        self.post_roll_until = timestamp + datetime.timedelta(seconds=self.post_roll_seconds)
+                else:
+                    self.end_clip()
                 self.event_id = self.event_id + 1
+            elif self.post_roll_event_id is not None and self.in_post_roll(timestamp):
+                info_dict['event_id'] = self.post_roll_event_id
+                self.save_file(self.frame_to_save(mrt, frame), timestamp, info_dict=info_dict,
+                               detailed_info_dict=detailed_info_dict)
+                self.post_roll_remaining -= 1
             else:
-                self.last_frame = frame
-                self.last_info_dict = info_dict
-                self.last_timestamp = timestamp
+                if self.post_roll_event_id is not None:
+                    self.post_roll_event_id = None
+                    self.end_clip()
+                self.pre_roll.add(frame, timestamp, info_dict)
             self.in_event = False
 
-        mrt.frame2 = frame2
+        # the result is handed to other threads: keep what they will read, release the rest
+        with self.plane_consumers_lock:
+            keep = set(self.plane_consumers)
+        mrt.detach(keep=keep)
+        if 'main' in keep and mrt.has_main:
+            # while the source still has it, rather than capturing it again later
+            mrt.main
+
+        return mrt
+
+    def pass_through(self, frame, info):
+        """
+        Handle a frame without running detection on it, for when the pipeline cannot keep up.
+        Events neither start nor end on such a frame, but it is still saved into an event or post-roll that is
+        under way, or kept in the pre-roll, so a clip has no holes.
+        """
+        timestamp = info.get('timestamp')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if timestamp is None:
+            timestamp = now
+        info['processed'] = now.isoformat()
+        info['detection_skipped'] = True
+
+        mrt = motion_detectors.MotionDetector1Result()
+        mrt.frame = frame
+        mrt.frame2 = frame
+        mrt.timestamp = timestamp
+        mrt.set_main(info.pop('main', None))
+        mrt.contour_area_ratio = 0
+        mrt.thresholded_area_ratio = 0
+        mrt.bounding_rects = []
+
+        info_dict = {
+            "source_info": info,
+        }
+
+        if self.in_event:
+            info_dict['event_id'] = self.event_id
+            self.save_file(self.frame_to_save(mrt, frame), timestamp, info_dict=info_dict)
+        elif self.post_roll_event_id is not None and self.in_post_roll(timestamp):
+            info_dict['event_id'] = self.post_roll_event_id
+            self.save_file(self.frame_to_save(mrt, frame), timestamp, info_dict=info_dict)
+            self.post_roll_remaining -= 1
+        else:
+            self.pre_roll.add(frame, timestamp, info_dict)
+
+        with self.plane_consumers_lock:
+            main_wanted = 'main' in self.plane_consumers
+        if main_wanted and mrt.has_main:
+            mrt.main
 
         return mrt
 
+    @staticmethod
+    def frame_to_save(mrt, frame: np.ndarray) -> np.ndarray:
+        """
+        The full resolution frame from a dual-stream source, otherwise the frame detection ran on. Pre-roll
+        frames are kept at detection size: by the time an event starts their full resolution frames are gone.
+        """
+        return mrt.main if mrt.has_main else frame
+
+    def save_frames(self, frame: np.ndarray, mrt, frame2: np.ndarray, timestamp: datetime.datetime,
+                    info_dict: dict, detailed_info_dict: dict):
+        """save the frame along with whichever derived images are wanted"""
+        # the encodes are shared with the stream clients through the result's JPEG cache
+        if mrt.has_main:
+            # boxes stay in the coordinates of the detection frame, record its size next to them
+            detailed_info_dict = dict(detailed_info_dict, detection_size=frame.shape[1::-1])
+            self.save_file(mrt.main, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict,
+                           jpeg=functools.partial(mrt.get_jpeg, "main", 95))
+        else:
+            # the /video_feed clients ask for frame2, the same image unless it is marked up
+            plane = "frame2" if frame2 is frame else "frame"
+            self.save_file(frame, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict,
+                           jpeg=functools.partial(mrt.get_jpeg, plane, 95))
+        if self.save_background:
+            self.save_file(mrt.background, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict,
+                           suffix="-background", jpeg=functools.partial(mrt.get_jpeg, "background", 95))
+        if self.save_delta:
+            self.save_file(mrt.frame_delta, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict,
+                           suffix="-delta", jpeg=functools.partial(mrt.get_jpeg, "frame_delta", 95))
+        if self.save_eroded:
+            self.save_file(mrt.threshold_after_erode, timestamp, info_dict=info_dict,
+                           detailed_info_dict=detailed_info_dict,
+                           suffix="-eroded", one_bit=True,
+                           jpeg=functools.partial(mrt.get_jpeg, "threshold_after_erode", 95))
+        if self.save_marked_up:
+            self.save_file(frame2, timestamp, info_dict=info_dict, detailed_info_dict=detailed_info_dict,
+                           suffix="-markedup", jpeg=functools.partial(mrt.get_jpeg, "frame2", 95))
+
+    def start_clip(self, timestamp: datetime.datetime, frame_size: tuple):
+        """frame_size (width, height) of the frames the event itself saves, the pre-roll is scaled to it"""
+        if self.output_format != 'clip':
+            return
+        self.end_clip()
+        self.clip = clip_writer.EventClip(self.output_directory, self.event_id, timestamp, fourcc=self.clip_fourcc,
+                                          extension=self.clip_extension, fps=self.clip_fps, frame_size=frame_size)
+
+    def end_clip(self):
+        if self.clip is not None:
+            self.clip_saver.submit(self.clip.close)
+            self.clip = None
+
+    def in_post_roll(self, timestamp: datetime.datetime) -> bool:
+        if self.post_roll_remaining > 0:
+            return True
+        return self.post_roll_until is not None and timestamp <= self.post_roll_until
+
+    def find_contours(self, mrt, t_frame: np.ndarray, changed: int, total_area: int):
+        """
+        Contours of the mask, skipping the work for frames that cannot be a hit. The mask is screened in
+        tiles first: quiet frames stop there, and the others are only searched within each group of touching
+        active tiles. A frame the screen rules out reports no contours, so its contour_area_ratio is 0 and it
+        has no boxes even if some pixels changed; its thresholded_area_ratio is still the real one.
+        """
+        if changed == 0:
+            if self.tile_size:
+                mrt.tile_size = self.tile_size
+                mrt.tile_activity = np.zeros((-(-t_frame.shape[0] // self.tile_size),
+                                              -(-t_frame.shape[1] // self.tile_size)), np.int32)
+            return []
+
+        if not self.tile_size:
+            contours, _ = cv2.findContours(t_frame, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            return contours
+
+        tile = self.tile_size
+        mrt.tile_size = tile
+        mrt.tile_activity = motion_detectors.tile_activity(t_frame, tile)
+        active = mrt.tile_activity > 0
+
+        # the contours are still wanted for frames that are drawn on or that close an event
+        contours_wanted = self.in_event or (self.save_marked_up and self.do_draw_contours)
+        if not contours_wanted:
+            bound = motion_detectors.tile_area_bound(active, tile, t_frame.shape)
+            if bound / total_area <= self.hit_ratio:
+                return []
+
+        # a blob only spans touching tiles, so each group of them can be searched on its own
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(active.astype(np.uint8), connectivity=8)
+        contours = []
+        for label in range(1, count):
+            tx, ty, tw, th, _ = stats[label]
+            y0, y1 = ty * tile, min((ty + th) * tile, t_frame.shape[0])
+            x0, x1 = tx * tile, min((tx + tw) * tile, t_frame.shape[1])
+            region = t_frame[y0:y1, x0:x1]
+            group = labels[ty:ty + th, tx:tx + tw]
+            if np.any((group != label) & (group != 0)):
+                # another group reaches into this one's bounding box, leave its pixels out
+                mine = np.repeat(np.repeat(group == label, tile, axis=0), tile, axis=1)[:y1 - y0, :x1 - x0]
+                region = np.where(mine, region, 0).astype(np.uint8)
+            found, _ = cv2.findContours(region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                        offset=(int(x0), int(y0)))
+            contours.extend(found)
+        return contours
+
+    @staticmethod
+    def scale_contours(contours, scale):
+        """map contours found on the detection plane back onto full frame coordinates"""
+        if scale == (1.0, 1.0):
+            return contours
+        factors = np.array(scale, dtype=np.float32)
+        return [np.rint(contour * factors).astype(np.int32) for contour in contours]
+
     @staticmethod
     def draw_text(frame: np.ndarray, text: str):
         height, width, channels = frame.shape
@@ -172,8 +414,54 @@ class ChangeProcessor:
 
         cv2.putText(frame, text, text_origin, font, font_scale, color, thickness, cv2.LINE_AA)
 
+    def flush(self, timeout: float = None):
+        """wait for the files queued so far to be written"""
+        if self.saver is not None:
+            self.saver.flush(timeout)
+        if self.clip_saver is not None:
+            self.clip_saver.flush(timeout)
+
+    def close(self):
+        if self.saver is not None:
+            self.saver.close()
+        if self.clip_saver is not None:
+            self.end_clip()
+            self.clip_saver.close()
+
+    def stats(self) -> dict:
+        return {
+            'event_id': self.event_id,
+            'in_event': self.in_event,
+            'pre_roll': self.pre_roll.stats(),
+            'saver': None if self.saver is None else self.saver.stats(),
+            'clip_saver': None if self.clip_saver is None else self.clip_saver.stats(),
+        }
+
     def save_file(self, frame: np.ndarray, timestamp: datetime.datetime, info_dict: dict = None,
-                  detailed_info_dict: dict = None, description: str = None, suffix: str = "", one_bit=False):
+                  detailed_info_dict: dict = None, description: str = None, suffix: str = "", one_bit=False,
+                  jpeg: bytes = None):
+        """queue a frame to be written; derived images (with a suffix) are the first to go if the writer is behind"""
+        if self.clip is not None:
+            self.clip_saver.submit(functools.partial(self.clip.write, frame, timestamp, info_dict=info_dict,
+                                                     detailed_info_dict=detailed_info_dict, suffix=suffix,
+                                                     jpeg=jpeg))
+            return
+
+        job = functools.partial(self.write_file, frame, timestamp, info_dict=info_dict,
+                                detailed_info_dict=detailed_info_dict, description=description, suffix=suffix,
+                                one_bit=one_bit, jpeg=jpeg)
+        if self.saver is None:
+            job()
+        else:
+            self.saver.submit(job, derived=suffix != "")
+
+    def write_file(self, frame: np.ndarray, timestamp: datetime.datetime, info_dict: dict = None,
+                   detailed_info_dict: dict = None, description: str = None, suffix: str = "", one_bit=False,
+                   jpeg: bytes = None):
+        """
+        Write frame, with the info dicts in its EXIF. jpeg is the frame already encoded, or a callable that
+        encodes it; if it is given the frame itself is not encoded again.
+        """
         if info_dict is None:
             info_dict = {}
         info_s = json.dumps(info_dict, default=utilities.json_serializer)
@@ -205,6 +493,12 @@ class ChangeProcessor:
         fn = f'{yyyymmddhhmmss}-{ms:03}'
 
         exif_bytes = piexif.dump(exif_dict)
+        if callable(jpeg):
+            jpeg = jpeg()
+        if jpeg is not None:
+            piexif.insert(exif_bytes, jpeg, f'{self.output_directory}/{fn}{suffix}.jpg')
+            return
+
         pil_image = utilities.make_pillow_from_cv2(frame)
         if one_bit:
             # this does not help with JPEG output, but leaving it in
@@ -0,0 +1,83 @@
+import datetime
+import logging
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import utilities
+
+logger = logging.getLogger("clip_writer")
+logger.setLevel(logging.INFO)
+
+
+class EventClip:
+    """
+    One event written as video: a clip per variant (the raw frames, and -background, -delta, ... if they are
+    being saved) plus a JSON lines sidecar with each frame's timestamp and metadata. Not thread safe; all calls
+    are expected to come from one writer thread, in order.
+
+    frame_size (width, height) is the size of the raw clip. It is given up front because the first frames
+    written are the pre-roll, which may be smaller than the frames of the event itself; they are scaled up to it.
+    The other variants take the size of their first frame.
+    """
+    def __init__(self, directory: str, event_id: int, timestamp: datetime.datetime, fourcc: str = 'mp4v',
+                 extension: str = '.mp4', fps: float = 10, frame_size: tuple = None):
+        self.base = Path(directory) / f"{timestamp.strftime('%Y%m%d-%H%M%S')}-event{event_id}"
+        self.event_id = event_id
+        self.fourcc = fourcc
+        self.extension = extension
+        self.fps = fps
+        self.frame_size = None if frame_size is None else tuple(frame_size)
+
+        self.writers = {}  # suffix -> (VideoWriter, (width, height), frames written)
+        self.sidecar = None
+
+    def write(self, frame: np.ndarray, timestamp: datetime.datetime, info_dict: dict = None,
+              detailed_info_dict: dict = None, suffix: str = "", jpeg: bytes = None):
+        if frame is None:
+            frame = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        if frame.dtype != np.uint8:
+            frame = cv2.convertScaleAbs(frame)
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+        if suffix not in self.writers:
+            if suffix == "" and self.frame_size is not None:
+                width, height = self.frame_size
+            else:
+                height, width = frame.shape[:2]
+            filename = f"{self.base}{suffix}{self.extension}"
+            logger.info("opening %s with fourcc '%s' and size %dx%d", filename, self.fourcc, width, height)
+            writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height))
+            if not writer.isOpened():
+                raise IOError(f"cannot open {filename} for writing with fourcc '{self.fourcc}'")
+            self.writers[suffix] = [writer, (width, height), 0]
+        entry = self.writers[suffix]
+        writer, size, index = entry
+
+        if frame.shape[1::-1] != size:
+            # e.g. a shrunken pre-roll frame, or one from the detection stream of a dual-stream camera
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR)
+        writer.write(frame)
+        entry[2] = index + 1
+
+        if self.sidecar is None:
+            self.sidecar = open(f"{self.base}.jsonl", 'w')
+        record = {
+            'clip': suffix,
+            'frame': index,
+            'timestamp': timestamp,
+            'info': info_dict or {},
+            'details': detailed_info_dict or {},
+        }
+        self.sidecar.write(utilities.compact_json(record) + '\n')
+
+    def close(self):
+        for suffix, (writer, size, count) in self.writers.items():
+            writer.release()
+            logger.info("closed %s%s%s after %d frames", self.base, suffix, self.extension, count)
+        self.writers = {}
+        if self.sidecar is not None:
+            self.sidecar.close()
+            self.sidecar = None
@@ -1,6 +1,9 @@
+import collections
+import datetime
 import logging
 import time
 import threading
+import weakref
 
 ev_logger = logging.getLogger("distributor.events")
 ev_logger.setLevel(logging.INFO)
@@ -20,86 +23,215 @@ except ImportError:
         logger.info("imported _thread")
 
 
+class SlowConsumerError(Exception):
+    """raised to a receiver that has stayed behind the distributor's hard lag limit for too long"""
+    pass
+
+
 class DistributorEvent(object):
-    """An Event-like class that signals all active clients when a new frame is
-    available.
     """
-    def __init__(self):
-        self.events = {}
+    Broadcasts new frames to all active clients. Every published frame gets the next sequence number, and a
+    client waits for a sequence newer than the last one it consumed, so it can neither miss the newest frame nor
+    read the same one twice. Publishing is a single notify_all however many clients there are.
+    The last few frames are kept as (sequence, value, published, captured) so a client that fell behind can be
+    handed the frames it missed in order, as long as it is within its budget. published is time.monotonic() at
+    publishing, captured is the capture time in seconds since the epoch, which is only for reporting: a replayed
+    file's frames can be captured months ago.
+    """
+    def __init__(self, stale_after: float = 5, history: int = 1):
+        self.condition = threading.Condition()
+        self.sequence = 0  # sequence number of value, 0 until something is published
+        self.value = None
+        self.history = collections.deque(maxlen=max(1, history))
+        self.stale_after = stale_after
+        self.clients = {}  # ident -> time the client last waited
+        self.last_sweep = time.time()
+
+    def wait(self, after: int = 0, timeout: float = None):
+        """
+        Invoked from each client's thread to wait for a frame newer than sequence number after.
+        Returns (sequence, value), which is the newest frame, or the current one on timeout.
+        """
+        ident = get_ident()
+        ev_logger.debug("thread %s is going to wait for a sequence after %d", ident, after)
+        with self.condition:
+            self.clients[ident] = time.time()
+            self.condition.wait_for(lambda: self.sequence > after, timeout)
+            return self.sequence, self.value
 
-    def wait(self):
-        """Invoked from each client's thread to wait for the next frame."""
+    def wait_next(self, after: int, max_frames: int = 0, max_age: float = None, timeout: float = None):
+        """
+        Like wait(), but hands out the frame right after sequence number after, so a client sees every frame.
+        Skips to the newest frame when that one is more than max_frames behind the newest or, if max_age is
+        set, was published more than max_age seconds ago.
+        Returns (sequence, value, published, captured, newest sequence), or None on timeout.
+        """
         ident = get_ident()
-        ev_logger.debug("thread %s is going to wait", ident)
-        if ident not in self.events:
-            # this is a new client
-            # add an entry for it in the self.events dict
-            # each entry has two elements, a threading.Event() and a timestamp
-            self.events[ident] = [threading.Event(), time.time()]
-        return self.events[ident][0].wait()
-
-    def set(self):
+        ev_logger.debug("thread %s is going to wait for the next sequence after %d", ident, after)
+        with self.condition:
+            self.clients[ident] = time.time()
+            if not self.condition.wait_for(lambda: self.sequence > after, timeout):
+                return None
+            entry = self.history[-1]
+            if max_frames > 0 and after and self.sequence - after <= max_frames + 1:
+                # the frame right after the one the client has seen, the history is long enough to still hold it
+                candidate = self.history[after + 1 - self.history[0][0]]
+                if max_age is None or time.monotonic() - candidate[2] <= max_age:
+                    entry = candidate
+            return entry + (self.sequence,)
+
+    def publish(self, value, captured: float = None):
         """Invoked by the camera thread when a new frame is available."""
-        now = time.time()
-        remove = None
-        for ident, event in self.events.items():
-            if not event[0].isSet():
-                # if this client's event is not set, then set it
-                # also update the last set timestamp to now
-                event[0].set()
-                event[1] = now
-            else:
-                # if the client's event is already set, it means the client
-                # did not process a previous frame
-                # if the event stays set for more than 5 seconds, then assume
-                # the client is gone and remove it
-                if now - event[1] > 5:
-                    remove = ident  # TODO may want to get rid of all stale clients, not just one at a time
-        if remove:
-            del self.events[remove]
-
-    def clear(self):
-        """Invoked from each client's thread after a frame was processed."""
-        self.events[get_ident()][0].clear()
+        with self.condition:
+            self.value = value
+            self.sequence += 1
+            self.history.append((self.sequence, value, time.monotonic(), time.time() if captured is None else captured))
+            self.condition.notify_all()
+
+            now = time.time()
+            if now - self.last_sweep > 1:
+                # clients that have not waited for a while are assumed to be gone, drop them all in one pass
+                self.last_sweep = now
+                self.clients = {ident: seen for ident, seen in self.clients.items()
+                                if now - seen <= self.stale_after}
+
+    def client_count(self) -> int:
+        with self.condition:
+            return len(self.clients)
 
 
 class Receiver:
-    def __init__(self, distributor):
+    def __init__(self, distributor, droppable: bool = True):
+        """a receiver that is not droppable is never given a SlowConsumerError, e.g. one that fans frames out"""
         logger.info("creating %s", self)
         self.distributor = distributor
+        self.droppable = droppable
+
+        # sequence number of the last result handed out
+        self.sequence = 0
 
-        self.first_time = True
+        # lag counters, the time (monotonic) the last result handed out was published is what the next call
+        # measures against; its capture time (epoch) is only reported
+        self.published = None
+        self.captured = None
+        self.frames_behind = 0
+        self.lag_ms = 0
+        self.lag_ms_max = 0
+        self.lag_ms_total = 0
+        self.sent = 0
+        self.skipped = 0
+        self.over_limit_since = None
+        self.dropped = False
 
+        distributor.add_receiver(self)
         distributor.start_background_thread()
 
-    def get_last_result(self):
-        """Return the current camera frame."""
-        self.distributor.last_access = time.time()
+    def get_last_result(self, not_before: float = None, timeout: float = None):
+        """
+        Return the next camera frame, waiting for a new one if this receiver has already seen the newest.
+        A rate limited client passes the time (as from time.time()) its next frame is due as not_before, and gets
+        the newest frame at that time.
+        Returns None if no new frame came within timeout seconds.
+        Raises SlowConsumerError once the receiver has stayed past the distributor's drop limit.
+        """
+        now = time.time()
+        self.distributor.last_access = now
+        self._account_for_send(time.monotonic())
+
+        max_frames = self.distributor.lag_budget_frames
+        if not_before is not None:
+            # the frames in between were skipped on purpose, they do not need catching up on
+            max_frames = 0
+            if not_before > now:
+                time.sleep(not_before - now)
 
-        if self.distributor.last_result is None or not self.first_time:
-            # wait for a signal from the camera thread
-            ev_logger.debug("waiting for Distributor.event")
-            self.distributor.event.wait()
-            ev_logger.debug("got Distributor.event")
-            self.distributor.event.clear()
+        ev_logger.debug("waiting for Distributor.event")
+        after = self.sequence
+        entry = self.distributor.event.wait_next(after, max_frames=max_frames, max_age=self.distributor.lag_budget,
+                                                 timeout=timeout)
+        if entry is None:
+            ev_logger.debug("no Distributor.event within %s s", timeout)
+            # nothing was sent, so there is nothing to account for when the client comes back
+            self.published = None
+            return None
+        self.sequence, rv, self.published, self.captured, newest = entry
+        ev_logger.debug("got Distributor.event %d", self.sequence)
 
-        self.first_time = False
+        if after:
+            self.skipped += self.sequence - after - 1
+        self.frames_behind = newest - self.sequence
 
-        rv = self.distributor.last_result
         logger.debug("returning %s %s", type(rv), rv)
         return rv
 
+    def _account_for_send(self, now: float):
+        """the previous result has been sent once the client comes back for the next one, now is monotonic"""
+        if self.published is None:
+            return
+        self.lag_ms = (now - self.published) * 1000
+        self.lag_ms_max = max(self.lag_ms_max, self.lag_ms)
+        self.lag_ms_total += self.lag_ms
+        self.sent += 1
+
+        drop_lag = self.distributor.drop_lag
+        if drop_lag is None or not self.droppable or self.lag_ms <= drop_lag * 1000:
+            self.over_limit_since = None
+            return
+        if self.over_limit_since is None:
+            self.over_limit_since = now
+        elif now - self.over_limit_since > self.distributor.drop_after:
+            logger.warning("dropping %s, %.0f ms behind for %.1f s", self, self.lag_ms, now - self.over_limit_since)
+            self.dropped = True
+            self.close()
+            raise SlowConsumerError(f"{self} stayed more than {drop_lag} s behind for {self.distributor.drop_after} s")
+
+    def close(self):
+        self.distributor.remove_receiver(self)
+
+    def stats(self) -> dict:
+        return {
+            'sequence': self.sequence,
+            'frames_behind': self.frames_behind,
+            'lag_ms': self.lag_ms,
+            'lag_ms_max': self.lag_ms_max,
+            'lag_ms_mean': self.lag_ms_total / self.sent if self.sent else 0,
+            'sent': self.sent,
+            'skipped': self.skipped,
+            'captured': self.captured,
+            'dropped': self.dropped,
+        }
+
 
 class Distributor:
-    def __init__(self, source=None, background_timeout: int = None, start_background_immediately: bool = True):
+    def __init__(self, source=None, background_timeout: int = None, start_background_immediately: bool = True,
+                 timestamp=None, lag_budget_frames: int = 0, lag_budget: float = None, drop_lag: float = None,
+                 drop_after: float = 10):
+        """
+        timestamp maps a result to its capture time (datetime or seconds since the epoch), publish time if None;
+        it is reported in the receiver stats. Lags are measured from when the result was published here, so they
+        mean the same for a live camera and for replayed files.
+        A receiver gets the frames it missed in order while it is at most lag_budget_frames behind the newest
+        and, if lag_budget is set, those frames were published at most lag_budget seconds ago, otherwise it skips
+        to the newest. With the default budget of 0 every receiver always gets the newest frame.
+        A receiver whose frames were published more than drop_lag seconds before they are sent, for longer than
+        drop_after seconds, gets a SlowConsumerError.
+        """
         logger.info("creating %s", self)
         self.provider = source
         self.background_timeout = background_timeout
+        self.timestamp = timestamp
+        self.lag_budget_frames = lag_budget_frames
+        self.lag_budget = lag_budget
+        self.drop_lag = drop_lag
+        self.drop_after = drop_after
 
         self.thread = None  # background thread that reads input
         self.last_result = None  # current frame is stored here by background thread
         self.last_access = 0  # time of last client access to the source
-        self.event = DistributorEvent()
+        self.event = DistributorEvent(history=lag_budget_frames + 1)
+        self.receivers = weakref.WeakSet()
+        self.receivers_lock = threading.Lock()
+        self.dropped = 0
 
         if start_background_immediately:
             self.start_background_thread()
@@ -116,22 +248,53 @@ class Distributor:
             if self.last_result is None:
                 # wait until first frame is available
                 ev_logger.debug("waiting for first event")
-                self.event.wait()
+                self.event.wait(after=0)
                 ev_logger.debug("got first event")
         else:
             logger.info("background thread is already running")
 
-    def get_receiver(self) -> Receiver:
-        return Receiver(self)
+    def get_receiver(self, droppable: bool = True) -> Receiver:
+        return Receiver(self, droppable=droppable)
+
+    def add_receiver(self, receiver: Receiver):
+        with self.receivers_lock:
+            self.receivers.add(receiver)
+
+    def remove_receiver(self, receiver: Receiver):
+        with self.receivers_lock:
+            if receiver in self.receivers:
+                self.receivers.discard(receiver)
+                if receiver.dropped:
+                    self.dropped += 1
+
+    def stats(self) -> dict:
+        with self.receivers_lock:
+            receivers = list(self.receivers)
+        return {
+            'sequence': self.event.sequence,
+            'clients': self.event.client_count(),
+            'dropped': self.dropped,
+            'receivers': {str(id(receiver)): receiver.stats() for receiver in receivers},
+        }
+
+    def _captured(self, result) -> float:
+        if self.timestamp is None:
+            return time.time()
+        captured = self.timestamp(result)
+        if captured is None:
+            return time.time()
+        if isinstance(captured, datetime.datetime):
+            return captured.timestamp()
+        return captured
 
     def _thread(self):
         """Camera background thread."""
         logger.info('Started background thread: provider = %s', self.provider)
         input_iterator = self.provider
         for result in input_iterator():
-            ev_logger.debug("got %s, setting Distributor.event", type(result))
+            ev_logger.debug("got %s, publishing to Distributor.event", type(result))
             self.last_result = result
-            self.event.set()  # send signal to clients
+            self.event.publish(result, self._captured(result))  # send signal to clients
             time.sleep(0)
 
             # if there hasn't been any clients asking for frames in
@@ -0,0 +1,185 @@
+import atexit
+import collections
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+logger = logging.getLogger("frame_cache")
+logger.setLevel(logging.INFO)
+
+_CACHE_FILE = re.compile(r"[0-9a-f]{16}-\d+-\d+\.npy")
+
+
+class MappedFrameCache:
+    """
+    Decoded frames kept as .npy files and served as memory-mapped arrays, so a replay that loops over the same
+    files decodes each one once. Frames are mapped copy-on-write: a consumer that draws on one gets private
+    pages and the cached file stays as it was.
+
+    A file is keyed by the source's path, size, mtime and the variant (e.g. the decode scale), so an edited
+    source misses and its old entry is dropped. Entries are evicted least recently used first once max_bytes
+    would be exceeded; a loop over more frames than fit will evict each frame before it comes round again, so
+    size max_bytes for the whole loop. With a directory of its own the cache survives restarts, otherwise it
+    lives in a temporary directory that is removed at exit. The files an earlier run left in the directory count
+    towards max_bytes from the start, oldest first in line for eviction, until a get() claims them.
+    """
+    def __init__(self, max_bytes: int, directory: str = None):
+        self.max_bytes = max_bytes
+        if directory is None:
+            self.directory = tempfile.mkdtemp(prefix="frame-cache-")
+            atexit.register(shutil.rmtree, self.directory, True)
+        else:
+            self.directory = directory
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # (path, variant) -> (cache file, stat key, nbytes); files from earlier runs are keyed by their name
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._invalidated = 0
+        self._evicted = 0
+        if directory is not None:
+            self._scan()
+
+    def _scan(self):
+        """
+        Take stock of what an earlier run left behind. Which source a file belongs to cannot be told from its
+        name, so each is entered under its own file name until get() asks for it under its (path, variant).
+        """
+        found = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith('.tmp'):
+                    # a write that was cut short
+                    os.remove(entry.path)
+                elif _CACHE_FILE.fullmatch(entry.name):
+                    st = entry.stat()
+                    found.append((st.st_mtime_ns, entry.path, st.st_size))
+        with self._lock:
+            for _, cache_file, nbytes in sorted(found):
+                self._entries[cache_file] = (cache_file, None, nbytes)
+                self._bytes += nbytes
+            self._make_room(0)
+        logger.info("%s: %d cached frames from earlier runs, %d bytes", self.directory, len(self._entries),
+                    self._bytes)
+
+    def _file_name(self, path: str, variant, stat_key: tuple) -> str:
+        digest = hashlib.sha1(f"{path}|{variant}".encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f"{digest}-{stat_key[0]}-{stat_key[1]}.npy")
+
+    @staticmethod
+    def _stat_key(path: str):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, path, variant=None):
+        """the cached frame for the file at path as it is now, None on a miss"""
+        path = os.fspath(path)
+        stat_key = self._stat_key(path)
+        key = (path, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] != stat_key:
+                logger.debug("%s has changed, dropping its cached frame", path)
+                self._drop(key)
+                self._invalidated += 1
+                entry = None
+            if entry is None:
+                # left behind by an earlier run?
+                cache_file = self._file_name(path, variant, stat_key)
+                entry = self._entries.pop(cache_file, None)
+                if entry is not None:
+                    # already counted, it only needs its proper key
+                    entry = (cache_file, stat_key, entry[2])
+                    self._entries[key] = entry
+                elif os.path.isfile(cache_file):
+                    nbytes = os.path.getsize(cache_file)
+                    if self._make_room(nbytes):
+                        entry = (cache_file, stat_key, nbytes)
+                        self._entries[key] = entry
+                        self._bytes += nbytes
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            cache_file = entry[0]
+        try:
+            # a plain ndarray view of the mapping, no copy
+            return np.load(cache_file, mmap_mode='c').view(np.ndarray)
+        except (OSError, ValueError):
+            logger.warning("cannot map %s, dropping it", cache_file)
+            with self._lock:
+                if key in self._entries:
+                    self._drop(key)
+            return None
+
+    def put(self, path, frame: np.ndarray, variant=None):
+        """store a frame decoded from the file at path, if it fits in the budget"""
+        path = os.fspath(path)
+        stat_key = self._stat_key(path)
+        key = (path, variant)
+        cache_file = self._file_name(path, variant, stat_key)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if cache_file in self._entries:
+                self._drop(cache_file)
+            if not self._make_room(frame.nbytes):
+                return
+            # reserve the room now, the write happens outside the lock
+            self._bytes += frame.nbytes
+        try:
+            temporary = cache_file + f".{threading.get_ident()}.tmp"
+            with open(temporary, 'wb') as f:
+                np.save(f, frame, allow_pickle=False)
+            os.replace(temporary, cache_file)
+        except OSError as e:
+            logger.warning("cannot cache %s: %s", path, e)
+            with self._lock:
+                self._bytes -= frame.nbytes
+            return
+        with self._lock:
+            nbytes = os.path.getsize(cache_file)
+            self._bytes += nbytes - frame.nbytes
+            self._entries[key] = (cache_file, stat_key, nbytes)
+
+    def _make_room(self, nbytes: int) -> bool:
+        """evict until nbytes fit, called with the lock held"""
+        if nbytes > self.max_bytes:
+            return False
+        while self._entries and self._bytes + nbytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self._evicted += 1
+        return self._bytes + nbytes <= self.max_bytes
+
+    def _drop(self, key):
+        """called with the lock held; arrays already mapped from the file stay valid"""
+        cache_file, _, nbytes = self._entries.pop(key)
+        self._bytes -= nbytes
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'invalidated': self._invalidated,
+                'evicted': self._evicted,
+            }
@@ -0,0 +1,95 @@
+import threading
+
+import cv2
+import numpy as np
+
+_stats_lock = threading.Lock()
+_hits = 0
+_misses = 0
+
+
+def stats() -> dict:
+    """hit and miss counts across every cache since startup"""
+    with _stats_lock:
+        total = _hits + _misses
+        return {
+            'hits': _hits,
+            'misses': _misses,
+            'hit_ratio': _hits / total if total else None,
+        }
+
+
+def _count(hit: bool):
+    global _hits, _misses
+    with _stats_lock:
+        if hit:
+            _hits += 1
+        else:
+            _misses += 1
+
+
+class EncodeError(Exception):
+    """raised when OpenCV cannot encode an image as JPEG"""
+    pass
+
+
+def encode(image: np.ndarray, quality: int, scale: float = 1.0) -> bytes:
+    if scale != 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    if image.dtype != np.uint8:
+        image = cv2.convertScaleAbs(image)
+    try:
+        ok, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    except cv2.error as e:
+        raise EncodeError(f"cannot encode a {image.shape} image: {e}") from e
+    if not ok:
+        raise EncodeError(f"cannot encode a {image.shape} image")
+    return data.tobytes()
+
+
+class _Entry:
+    __slots__ = ("ready", "data")
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.data = None
+
+
+class JpegCache:
+    """
+    Encoded variants of one result's planes, keyed by (plane, quality, scale). Each variant is encoded at most
+    once, by whichever reader asks first; readers asking for it meanwhile wait for that encode. A failed encode
+    raises EncodeError and is not cached, the next reader tries again.
+    """
+    __slots__ = ("_lock", "_entries")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, image: np.ndarray, key: tuple) -> bytes:
+        plane, quality, scale = key
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                owner = entry is None
+                if owner:
+                    entry = self._entries[key] = _Entry()
+            _count(not owner)
+
+            if not owner:
+                entry.ready.wait()
+                if entry.data is not None:
+                    return entry.data
+                # the encode we waited for failed, try it ourselves
+                continue
+
+            try:
+                entry.data = encode(image, quality, scale)
+            except BaseException:
+                with self._lock:
+                    del self._entries[key]
+                raise
+            finally:
+                entry.ready.set()
+            return entry.data
@@ -21,11 +21,12 @@ def main(argv):
     parser.add_argument('--markup', action='store_true')
     parser.add_argument('--fps', type=float, default=10)
     parser.add_argument('--fourcc')
+    parser.add_argument('--scale', type=float, default=1.0, help="frame size relative to the images, e.g. 0.5")
     args = parser.parse_args(argv)
     logging.info("Invoked with %s", args)
 
     image_dir = args.directory
-    image_source = FilesFrameSource(directory=image_dir, glob=args.glob, forever=False)
+    image_source = FilesFrameSource(directory=image_dir, glob=args.glob, forever=False, decode_scale=args.scale)
 
     fourcc_string = args.fourcc
     if fourcc_string is None:
@@ -1,79 +1,524 @@
+import functools
+
 import cv2
 import numpy as np
 
+import jpeg_cache
+
 
 class MotionDetector1Result:
+    """
+    Result of one frame through the detector. The intermediate planes (background, frame_delta, threshold,
+    threshold_after_erode) are only materialised when somebody reads them: borrowed buffers are copied and
+    placeholders are built on first access. detach() releases whatever has not been asked for.
+    """
+    PLANES = ("background", "frame_delta", "threshold", "threshold_after_erode")
+
+    __slots__ = ("frame", "frame2", "derived_data_is_valid", "scale", "borrowed",
+                 "contour_area_ratio", "thresholded_area_ratio", "bounding_rects",
+                 "tile_activity", "tile_size", "active_area", "timestamp",
+                 "_main", "_pending", "_planes", "_jpeg_cache")
+
     def __init__(self):
         self.frame = None
-        self.background = None
-        self.frame_delta = None
-        self.threshold = None
-        self.threshold_after_erode = None
+        self.frame2 = None
         self.derived_data_is_valid = False
+        # factors that map detection plane coordinates back to frame coordinates
+        self.scale = (1.0, 1.0)
+        # planes point into buffers the detector reuses on the next frame
+        self.borrowed = False
+        self.contour_area_ratio = None
+        self.thresholded_area_ratio = None
+        self.bounding_rects = None
+        # changed pixel counts per tile_size x tile_size tile of the detection plane
+        self.tile_activity = None
+        self.tile_size = None
+        # number of detection plane pixels inside the motion zones, None when the whole plane is watched
+        self.active_area = None
+        # capture time of frame, filled in by whoever knows it
+        self.timestamp = None
+        # the full resolution frame as a source_images.DeferredFrame, when the source detects on a smaller one
+        self._main = None
+        # name -> array, or a callable that builds the array, for planes nobody has read yet
+        self._pending = {}
+        # name -> array for planes that have been read
+        self._planes = {}
+        self._jpeg_cache = jpeg_cache.JpegCache()
+
+    def set_plane(self, name: str, source):
+        """source is an array (copied on first access if borrowed) or a callable returning one"""
+        self._planes.pop(name, None)
+        self._pending[name] = source
+
+    def get_plane(self, name: str):
+        plane = self._planes.get(name)
+        if plane is None:
+            source = self._pending.pop(name, None)
+            if source is None:
+                return None
+            if callable(source):
+                plane = source()
+            elif self.borrowed:
+                plane = source.copy()
+            else:
+                plane = source
+            self._planes[name] = plane
+        return plane
+
+    def peek_plane(self, name: str):
+        """the plane without copying it out; a borrowed plane is only good until the detector's next frame"""
+        plane = self._planes.get(name)
+        if plane is None:
+            source = self._pending.get(name)
+            if source is None or callable(source):
+                return self.get_plane(name)
+            plane = source
+        return plane
+
+    def set_main(self, main):
+        self._main = main
+
+    @property
+    def has_main(self) -> bool:
+        return self._main is not None
+
+    @property
+    def main(self):
+        """the full resolution frame, built on first access; just frame if the source did not deliver one"""
+        if self._main is None:
+            return self.frame
+        main = self._main.get()
+        return self.frame if main is None else main
+
+    @property
+    def background(self):
+        return self.get_plane("background")
+
+    @property
+    def frame_delta(self):
+        return self.get_plane("frame_delta")
+
+    @property
+    def threshold(self):
+        return self.get_plane("threshold")
+
+    @property
+    def threshold_after_erode(self):
+        return self.get_plane("threshold_after_erode")
+
+    def get_jpeg(self, plane: str = "frame2", quality: int = 95, scale: float = 1.0):
+        """
+        The plane (frame, frame2, main or one of PLANES) as JPEG bytes, encoded once per result no matter how many
+        stream clients and savers ask for it. None if the plane is not available.
+        """
+        image = getattr(self, plane)
+        if image is None:
+            return None
+        return self._jpeg_cache.get(image, (plane, quality, scale))
+
+    def detach(self, keep=("threshold_after_erode",)):
+        """
+        Make this result safe to hold on to past the next frame. Planes named in keep are materialised,
+        planes that nobody has read and nobody wants to keep are released.
+        """
+        for name in list(self._pending):
+            if name in keep:
+                self.get_plane(name)
+        self._pending.clear()
+        self.borrowed = False
 
     def items(self):
-        return self.__dict__.items()
+        """every attribute, including all the planes that are still available"""
+        rv = [(name, getattr(self, name)) for name in self.__slots__ if not name.startswith('_')]
+        rv.extend((name, self.get_plane(name)) for name in self.PLANES)
+        return rv
 
     def __str__(self):
-        return f"frame={type(self.frame)}, threshold_after_erode={type(self.threshold_after_erode)}"
+        return f"frame={type(self.frame)}, threshold_after_erode={type(self._planes.get('threshold_after_erode'))}"
+
 
+def tile_activity(mask: np.ndarray, tile_size: int) -> np.ndarray:
+    """changed pixel counts for each tile_size x tile_size tile of a 0/255 mask; edge tiles may be smaller"""
+    height, width = mask.shape[:2]
+    integral = cv2.integral(mask, sdepth=cv2.CV_32S)
+    ys = np.append(np.arange(0, height, tile_size), height)
+    xs = np.append(np.arange(0, width, tile_size), width)
+    sums = (integral[np.ix_(ys[1:], xs[1:])] - integral[np.ix_(ys[:-1], xs[1:])]
+            - integral[np.ix_(ys[1:], xs[:-1])] + integral[np.ix_(ys[:-1], xs[:-1])])
+    return sums // 255
 
-class MotionDetector1:
+
+def tile_area_bound(active: np.ndarray, tile_size: int, shape: tuple) -> int:
+    """
+    Upper bound on the total area of the external contours of a mask, given which of its tiles are active.
+    A blob only spans touching tiles, so no contour reaches outside the bounding box of its group of tiles.
+    """
+    height, width = shape[:2]
+    count, _, stats, _ = cv2.connectedComponentsWithStats(active.astype(np.uint8), connectivity=8)
+    bound = 0
+    for x, y, w, h, _ in stats[1:]:
+        bound += (min((x + w) * tile_size, width) - x * tile_size) * (min((y + h) * tile_size, height) - y * tile_size)
+    return int(bound)
+
+
+class MotionDetector:
+    """
+    The parts shared by every detection engine: scaling down to the detection plane, cropping to the motion zones,
+    blurring, and thresholding and eroding whatever delta the engine comes up with. Engines implement _start
+    and _update, which work on the cropped, blurred grayscale frame.
+    """
     def __init__(self,
                  threshold: int = 25,
-                 accumulate_alpha: float = 0.5,
                  post_threshold_erode_iterations: int = 1,
                  blur_size: int = 3,
+                 detect_scale: float = 1.0,
+                 detect_width: int = None,
+                 reuse_buffers: bool = False,
+                 zones: dict = None,
                  strict_args = True,
                  **kwargs):
 
         if strict_args and len(kwargs) > 0:
             raise TypeError(f"unexpected arguments: {kwargs}")
 
-        self._background = None
+        if detect_scale <= 0 or detect_scale > 1:
+            raise ValueError(f"detect_scale must be in (0, 1], not {detect_scale}")
+
         self._dp_threshold = threshold
-        self._dp_accumulate_alpha = accumulate_alpha
         self._dp_post_threshold_erode_iterations = post_threshold_erode_iterations
         self._dp_blur_size = blur_size
+        self._dp_detect_scale = detect_scale
+        self._dp_detect_width = detect_width
+        self._dp_reuse_buffers = reuse_buffers
 
-    def process_frame(self, frame: np.ndarray):
-        rv = MotionDetector1Result()
-        rv.frame = frame
+        # polygons in frame coordinates, [[x, y], [x, y], ...]
+        zones = zones or {}
+        self._dp_include_zones = [np.array(polygon, dtype=np.float64) for polygon in zones.get('include', [])]
+        self._dp_exclude_zones = [np.array(polygon, dtype=np.float64) for polygon in zones.get('exclude', [])]
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (self._dp_blur_size, self._dp_blur_size), 0)  # Reduce noise
+        # the engine has a background model for the current detection plane
+        self._started = False
 
-        # Initialize running average
-        if self._background is None:
-            self._background = gray.copy().astype("float")
-            rv.background = self._background.copy()
+        self._buffers = {}
+        self._placeholder = None
+
+        # zone mask for the current frame size, rasterised on the detection plane
+        self._zone_key = None
+        self._zone_mask = None
+        self._zone_roi = None
+        self._zone_area = None
+        self._cropped = False
+
+    def detection_size(self, frame_width: int, frame_height: int):
+        """(width, height) of the plane that detection runs on for a frame of the given size"""
+        if self._dp_detect_width is not None and self._dp_detect_width < frame_width:
+            scale = self._dp_detect_width / frame_width
+        else:
+            scale = self._dp_detect_scale
+        return max(1, round(frame_width * scale)), max(1, round(frame_height * scale))
+
+    def _update_zones(self, frame_width: int, frame_height: int, width: int, height: int):
+        """rasterise the zones for this frame size, and find the part of the detection plane they cover"""
+        key = (frame_width, frame_height, width, height)
+        if key == self._zone_key:
+            return
+        # frame size (or detection size) changed underneath us, start over
+        self._zone_key = key
+        self._started = False
+
+        if len(self._dp_include_zones) == 0 and len(self._dp_exclude_zones) == 0:
+            self._zone_mask = None
+            self._zone_roi = (0, 0, width, height)
+            self._zone_area = None
+            self._cropped = False
+            return
+
+        factors = np.array((width / frame_width, height / frame_height))
 
-            height, width, channels = frame.shape
+        def rasterise(polygons):
+            return [np.rint(polygon * factors).astype(np.int32) for polygon in polygons]
+
+        if len(self._dp_include_zones) > 0:
+            mask = np.zeros((height, width), np.uint8)
+            cv2.fillPoly(mask, rasterise(self._dp_include_zones), 255)
+        else:
+            mask = np.full((height, width), 255, np.uint8)
+        if len(self._dp_exclude_zones) > 0:
+            cv2.fillPoly(mask, rasterise(self._dp_exclude_zones), 0)
+
+        x, y, w, h = cv2.boundingRect(mask)
+        if w == 0 or h == 0:
+            raise ValueError(f"motion zones leave nothing to watch in a {frame_width}x{frame_height} frame")
+
+        self._zone_roi = (x, y, x + w, y + h)
+        self._zone_area = cv2.countNonZero(mask)
+        # no need to mask anything if the zones are a plain rectangle
+        self._zone_mask = None if self._zone_area == w * h else mask
+        self._cropped = (w, h) != (width, height)
+
+    def _buffer(self, name: str, shape: tuple, dtype=np.uint8, plane: bool = False):
+        """
+        A persistent work buffer when reusing buffers. Otherwise None, so OpenCV allocates a fresh one, unless it
+        is a result plane and detection is cropped to the zones; then it is a fresh plane, blank outside the crop.
+        """
+        if not self._dp_reuse_buffers:
+            return np.zeros(shape, dtype) if plane and self._cropped else None
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            # zeros, since only the cropped region of a plane is ever written to
+            buffer = np.zeros(shape, dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    def _crop(self, plane):
+        if plane is None:
+            return None
+        x0, y0, x1, y1 = self._zone_roi
+        return plane[y0:y1, x0:x1]
+
+    def _output(self, name: str, plane_shape: tuple):
+        """(plane, cropped view of it to write into); both are None when OpenCV should allocate the output"""
+        plane = self._buffer(name, plane_shape, plane=True)
+        return plane, self._crop(plane)
+
+    @staticmethod
+    def _publish(rv: MotionDetector1Result, name: str, plane, cropped: np.ndarray):
+        rv.set_plane(name, cropped if plane is None else plane)
+
+    def _get_placeholder(self, width: int, height: int):
+        """solid blue stand-in for the derived planes until there is a background to compare against"""
+        if self._placeholder is None or self._placeholder.shape[:2] != (height, width):
             fill_color = (255, 0, 0)
             block = np.zeros((height, width, 3), np.uint8)
             block[:] = fill_color
+            block.flags.writeable = False
+            self._placeholder = block
+        return self._placeholder
 
-            rv.frame_delta = block
-            rv.threshold = block
-            rv.threshold_after_erode = block
-        else:
-            rv.background = self._background.copy()
+    def _start(self, rv: MotionDetector1Result, gray: np.ndarray, plane_shape: tuple):
+        """set up the background model from the first cropped frame, and publish the background plane"""
+        raise NotImplementedError
 
-            # Update running average: weighted sum
-            cv2.accumulateWeighted(gray, self._background, self._dp_accumulate_alpha)
-            rv.background = self._background
+    def _update(self, rv: MotionDetector1Result, gray: np.ndarray, plane_shape: tuple) -> np.ndarray:
+        """
+        Update the background model with a cropped frame, publish the background and frame_delta planes, and
+        return the cropped delta for thresholding, or None while the model is still too new to compare against.
+        """
+        raise NotImplementedError
 
-            # Convert back to uint8 for difference calculation
-            frame_delta = cv2.absdiff(gray, cv2.convertScaleAbs(self._background))
-            rv.frame_delta = frame_delta
+    def process_frame(self, frame: np.ndarray):
+        rv = MotionDetector1Result()
+        rv.frame = frame
+        rv.borrowed = self._dp_reuse_buffers
+
+        frame_height, frame_width = frame.shape[:2]
+        width, height = self.detection_size(frame_width, frame_height)
+        if (width, height) != (frame_width, frame_height):
+            rv.scale = (frame_width / width, frame_height / height)
+        self._update_zones(frame_width, frame_height, width, height)
+        rv.active_area = self._zone_area
 
+        # only the bounding box of the zones is looked at, in frame and in detection plane coordinates
+        x0, y0, x1, y1 = self._zone_roi
+        sx, sy = rv.scale
+        frame = frame[round(y0 * sy):round(y1 * sy), round(x0 * sx):round(x1 * sx)]
+        roi_width, roi_height = x1 - x0, y1 - y0
+        roi_shape = (roi_height, roi_width)
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._buffer("frame_gray", frame.shape[:2]))
+        if gray.shape != roi_shape:
+            # shrinking the single channel plane is much cheaper than shrinking the colour frame
+            gray = cv2.resize(gray, (roi_width, roi_height), dst=self._buffer("gray", roi_shape),
+                              interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(gray, (self._dp_blur_size, self._dp_blur_size), 0,
+                                dst=self._buffer("blurred", roi_shape))  # Reduce noise
+
+        plane_shape = (height, width)
+        frame_delta = None
+        if not self._started:
+            self._start(rv, gray, plane_shape)
+            self._started = True
+        else:
+            frame_delta = self._update(rv, gray, plane_shape)
+
+        if frame_delta is None:
+            # nothing to compare against yet
+            placeholder = functools.partial(self._get_placeholder, width, height)
+            for name in ("frame_delta", "threshold", "threshold_after_erode"):
+                rv.set_plane(name, placeholder)
+        else:
             # Threshold the image
-            thresh = cv2.threshold(frame_delta, self._dp_threshold, 255, cv2.THRESH_BINARY)[1]
-            rv.threshold = thresh
+            plane, cropped = self._output("threshold", plane_shape)
+            thresh = cv2.threshold(frame_delta, self._dp_threshold, 255, cv2.THRESH_BINARY, dst=cropped)[1]
+            if self._zone_mask is not None:
+                # excluded pixels never count as changed
+                cv2.bitwise_and(thresh, self._crop(self._zone_mask), dst=thresh)
+            self._publish(rv, "threshold", plane, thresh)
 
-            thresh = cv2.erode(thresh, None, iterations=self._dp_post_threshold_erode_iterations)
-            rv.threshold_after_erode = thresh
+            plane, cropped = self._output("eroded", plane_shape)
+            thresh = cv2.erode(thresh, None, dst=cropped, iterations=self._dp_post_threshold_erode_iterations)
+            self._publish(rv, "threshold_after_erode", plane, thresh)
 
             rv.derived_data_is_valid = True
 
         return rv
+
+
+class MotionDetector1(MotionDetector):
+    """running average of the frames as the background, the delta is the distance from it"""
+
+    # background model units per gray level
+    _model_scale = 1
+
+    def __init__(self, accumulate_alpha: float = 0.5, **kwargs):
+        super().__init__(**kwargs)
+        self._background = None
+        self._dp_accumulate_alpha = accumulate_alpha
+
+    def _model_dtype(self):
+        # float32 is plenty for a running average of 8 bit pixels, and half the size of float64
+        return np.float32 if self._dp_reuse_buffers else np.float64
+
+    def _accumulate(self, gray: np.ndarray):
+        # Update running average: weighted sum
+        cv2.accumulateWeighted(gray, self._crop(self._background), self._dp_accumulate_alpha)
+
+    def _publish_background(self, rv: MotionDetector1Result, plane_shape: tuple) -> np.ndarray:
+        # Convert back to uint8 for difference calculation
+        plane, cropped = self._output("background", plane_shape)
+        background = cv2.convertScaleAbs(self._crop(self._background), dst=cropped, alpha=1 / self._model_scale)
+        self._publish(rv, "background", plane, background)
+        return background
+
+    def _start(self, rv: MotionDetector1Result, gray: np.ndarray, plane_shape: tuple):
+        # Initialize running average
+        self._background = np.zeros(plane_shape, self._model_dtype())
+        model = self._crop(self._background)
+        model[:] = gray
+        if self._model_scale != 1:
+            model *= self._model_scale
+        self._publish_background(rv, plane_shape)
+
+    def _update(self, rv: MotionDetector1Result, gray: np.ndarray, plane_shape: tuple) -> np.ndarray:
+        self._accumulate(gray)
+        background = self._publish_background(rv, plane_shape)
+
+        plane, cropped = self._output("delta", plane_shape)
+        frame_delta = cv2.absdiff(gray, background, dst=cropped)
+        self._publish(rv, "frame_delta", plane, frame_delta)
+        return frame_delta
+
+
+class FixedPointMotionDetector(MotionDetector1):
+    """
+    The same running average, kept as uint16 with 8 fractional bits instead of floating point. It is a quarter of
+    the size of the float64 model. The gray frame is widened into a uint16 buffer first, as addWeighted on
+    mixed types takes OpenCV's slow path: at 1640x1232 the update is about 1.2ms against 2.4ms.
+    """
+    _model_scale = 256
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._widened = None
+
+    def _model_dtype(self):
+        return np.uint16
+
+    def _widen(self, gray: np.ndarray) -> np.ndarray:
+        """gray * 256 as uint16, so both sides of addWeighted are the same type"""
+        if self._widened is None or self._widened.shape != gray.shape:
+            self._widened = np.empty(gray.shape, np.uint16)
+        return np.left_shift(gray, 8, out=self._widened, dtype=np.uint16)
+
+    def _accumulate(self, gray: np.ndarray):
+        model = self._crop(self._background)
+        alpha = self._dp_accumulate_alpha
+        cv2.addWeighted(model, 1 - alpha, self._widen(gray), alpha, 0, dst=model)
+
+
+class OpenCVSubtractorMotionDetector(MotionDetector):
+    """
+    Wraps one of OpenCV's background subtractors. Its foreground mask is the frame_delta plane (255 for
+    foreground, 127 for shadows), so the default threshold keeps foreground and drops shadows.
+
+    A new model calls most of the frame foreground until it has seen a few frames (KNN needs four of a static
+    scene), so nothing is reported for the first warm_up_frames frames after a (re)start.
+    """
+    def __init__(self, learning_rate: float = -1, history: int = 500, detect_shadows: bool = True,
+                 warm_up_frames: int = 5, **kwargs):
+        kwargs.setdefault('threshold', 127)
+        super().__init__(**kwargs)
+        self._subtractor = None
+        self._dp_learning_rate = learning_rate
+        self._dp_history = history
+        self._dp_detect_shadows = detect_shadows
+        self._dp_warm_up_frames = warm_up_frames
+        self._warm_up_remaining = 0
+
+    def _create_subtractor(self):
+        raise NotImplementedError
+
+    def _background_image(self, plane_shape: tuple):
+        # getBackgroundImage is not cheap, so this is only called when somebody reads the background plane
+        background = self._subtractor.getBackgroundImage()
+        if not self._cropped:
+            return background
+        plane = np.zeros(plane_shape, np.uint8)
+        self._crop(plane)[:] = background
+        return plane
+
+    def _start(self, rv: MotionDetector1Result, gray: np.ndarray, plane_shape: tuple):
+        self._subtractor = self._create_subtractor()
+        self._subtractor.apply(gray, learningRate=1)
+        self._warm_up_remaining = self._dp_warm_up_frames - 1
+        rv.set_plane("background", functools.partial(self._background_image, plane_shape))
+
+    def _update(self, rv: MotionDetector1Result, gray: np.ndarray, plane_shape: tuple) -> np.ndarray:
+        if self._warm_up_remaining > 0:
+            # OpenCV's automatic rate, which averages over the frames seen so far
+            self._warm_up_remaining -= 1
+            self._subtractor.apply(gray, learningRate=-1)
+            rv.set_plane("background", functools.partial(self._background_image, plane_shape))
+            return None
+        plane, cropped = self._output("delta", plane_shape)
+        foreground = self._subtractor.apply(gray, fgmask=cropped, learningRate=self._dp_learning_rate)
+        self._publish(rv, "frame_delta", plane, foreground)
+        rv.set_plane("background", functools.partial(self._background_image, plane_shape))
+        return foreground
+
+
+class MOG2MotionDetector(OpenCVSubtractorMotionDetector):
+    def __init__(self, var_threshold: float = 16, **kwargs):
+        super().__init__(**kwargs)
+        self._dp_var_threshold = var_threshold
+
+    def _create_subtractor(self):
+        return cv2.createBackgroundSubtractorMOG2(history=self._dp_history, varThreshold=self._dp_var_threshold,
+                                                  detectShadows=self._dp_detect_shadows)
+
+
+class KNNMotionDetector(OpenCVSubtractorMotionDetector):
+    def __init__(self, dist2_threshold: float = 400, **kwargs):
+        super().__init__(**kwargs)
+        self._dp_dist2_threshold = dist2_threshold
+
+    def _create_subtractor(self):
+        return cv2.createBackgroundSubtractorKNN(history=self._dp_history, dist2Threshold=self._dp_dist2_threshold,
+                                                 detectShadows=self._dp_detect_shadows)
+
+
+# motion.engine -> detector class
+ENGINES = {
+    'running-average': MotionDetector1,
+    'fixed-point': FixedPointMotionDetector,
+    'mog2': MOG2MotionDetector,
+    'knn': KNNMotionDetector,
+}
+
+
+def fetch_motion_detector(engine: str = None, strict_args=True, **kwargs) -> MotionDetector:
+    """the detector for the engine; with strict_args an option it does not know is a TypeError"""
+    engine_class = ENGINES.get('running-average' if engine is None else engine.lower())
+    if engine_class is None:
+        raise AttributeError(f"unknown motion engine '{engine}', expected one of {list(ENGINES)}")
+    return engine_class(strict_args=strict_args, **kwargs)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+import configuration
+# noinspection PyUnresolvedReferences
+import custom_logging
+
+import argparse
+import copy
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from flask import abort, Flask, jsonify, render_template
+
+import distributor
+import jpeg_cache
+import shm_ring
+import shm_publisher
+import streaming
+
+configuration.configure()
+app = Flask(__name__)
+
+logger = logging.getLogger("multi_app")
+logger.setLevel(logging.INFO)
+
+# name -> Camera, filled in by main(); a spawned worker imports this module too and must not start anything
+cameras = {}
+
+
+def camera_settings() -> list:
+    """
+    The input section as a list of sources, each with a name and its motion and output settings. A source's own
+    motion and output entries are merged over the top level ones, and its output goes to a directory of its own
+    unless it names one.
+    """
+    inputs = configuration.settings.get('input', [])
+    if isinstance(inputs, dict):
+        inputs = [inputs]
+    rv = []
+    for index, entry in enumerate(inputs):
+        entry = dict(entry)
+        name = str(entry.pop('name', f"cam{index}"))
+        motion_parameters = configuration.merge(copy.deepcopy(configuration.settings.get('motion', {})),
+                                                entry.pop('motion', {}))
+        own_output = entry.pop('output', {})
+        output_parameters = configuration.merge(copy.deepcopy(configuration.settings.get('output', {})), own_output)
+        if 'directory' not in own_output:
+            output_parameters['directory'] = os.path.join(output_parameters.get('directory', 'output'), name)
+        rv.append((name, entry, motion_parameters, output_parameters))
+    return rv
+
+
+class Camera:
+    """one source: a detection worker process publishing into a frame ring, and a Distributor reading it back"""
+    def __init__(self, name: str, input_args: dict, motion_parameters: dict, output_parameters: dict,
+                 context: multiprocessing.context.BaseContext):
+        shm_args = configuration.settings.get('shm', {})
+        self.name = name
+        self.ring_name = f"{shm_args.get('name', 'jomo')}-{name}"
+        self.poll_interval = shm_args.get('poll_interval', 0.005)
+        self.ring = None
+        shm_ring.remove(self.ring_name)
+        os.makedirs(output_parameters.get('directory', 'output'), exist_ok=True)
+        self.process = context.Process(target=shm_publisher.publish, name=f"detect-{name}", daemon=True,
+                                       args=(input_args, self.ring_name),
+                                       kwargs={'slots': shm_args.get('slots', 8),
+                                               'motion_parameters': motion_parameters,
+                                               'output_parameters': output_parameters,
+                                               'pacing_parameters': configuration.settings.get('pacing', {})})
+        self.process.start()
+        logger.info("started %s for %s, pid %d", self.process.name, input_args, self.process.pid)
+        self.distributor = distributor.Distributor(source=self.source, timestamp=lambda result: result.timestamp,
+                                                   start_background_immediately=False,
+                                                   **configuration.settings.get('distributor', {}))
+
+    def source(self):
+        while self.ring is None:
+            try:
+                self.ring = shm_ring.FrameRing.attach(self.ring_name)
+                logger.info("attached to frame ring '%s'", self.ring_name)
+            except (FileNotFoundError, ValueError):
+                # not created yet, or created but not filled in yet
+                if not self.process.is_alive():
+                    logger.error("%s has exited with %s", self.process.name, self.process.exitcode)
+                    return
+                time.sleep(0.5)
+        yield from self.ring.results(poll_interval=self.poll_interval)
+
+    def stats(self) -> dict:
+        return {
+            'pid': self.process.pid,
+            'alive': self.process.is_alive(),
+            'ring': self.ring.stats() if self.ring is not None else None,
+            'distributor': self.distributor.stats(),
+        }
+
+    def close(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(5)
+
+
+def get_camera(name: str) -> Camera:
+    camera = cameras.get(name)
+    if camera is None:
+        abort(404)
+    if not camera.process.is_alive():
+        # its distributor would wait forever for a first frame
+        abort(503, description=f"the worker for {name} has exited with {camera.process.exitcode}")
+    return camera
+
+
+@app.route('/')
+def index():
+    """every camera's feeds on one page"""
+    return render_template('cams.html', names=list(cameras))
+
+
+@app.route('/cam/<name>/')
+def cam_index(name: str):
+    get_camera(name)
+    return render_template('cams.html', names=[name])
+
+
+def feed(name: str, plane: str, quality: int):
+    return streaming.feed(get_camera(name).distributor, plane, quality)
+
+
+@app.route('/cam/<name>/video_feed')
+def video_feed(name: str):
+    """Video streaming route. Put this in the src attribute of an img tag."""
+    return feed(name, 'frame2', 95)
+
+
+@app.route('/cam/<name>/diff_feed')
+def diff_feed(name: str):
+    """Video streaming route. Put this in the src attribute of an img tag."""
+    return feed(name, 'threshold_after_erode', 75)
+
+
+@app.route('/stats')
+def stats():
+    """counters for keeping an eye on every camera"""
+    return jsonify({
+        'cameras': {name: camera.stats() for name, camera in cameras.items()},
+        'jpeg_cache': jpeg_cache.stats(),
+    })
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    # spawn, not fork: the workers should not inherit this process's threads and locks
+    context = multiprocessing.get_context('spawn')
+    for name, input_args, motion_parameters, output_parameters in camera_settings():
+        if name in cameras:
+            raise ValueError(f"more than one input is called '{name}'")
+        cameras[name] = Camera(name, input_args, motion_parameters, output_parameters, context)
+    # stop the workers on a plain kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        app.run(host=args.host, port=args.port, threaded=True)
+    finally:
+        for camera in cameras.values():
+            camera.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
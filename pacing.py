@@ -0,0 +1,110 @@
+import logging
+import time
+
+logger = logging.getLogger("pacing")
+logger.setLevel(logging.INFO)
+
+
+class FramePacer:
+    """
+    Keeps a source loop on a fixed capture interval. Deadlines come from a monotonic clock and advance by the
+    interval each frame, so the time spent capturing, detecting and saving comes out of the sleep instead of
+    being added to it. A frame that finishes after its deadline is an overrun; the schedule then restarts from
+    now rather than bursting to catch up.
+
+    When degrade is on and degrade_after frames in a row overrun, detection only runs on every detect_every-th
+    frame until recover_after detecting frames in a row fit comfortably in the interval again.
+    """
+    def __init__(self, interval: float, degrade: bool = True, degrade_after: int = 3, recover_after: int = 10,
+                 detect_every: int = 2):
+        if detect_every < 1:
+            raise ValueError("detect_every must be at least 1")
+        self.interval = max(0.0, interval)
+        self.degrade = degrade
+        self.degrade_after = degrade_after
+        self.recover_after = recover_after
+        self.detect_every = detect_every
+
+        self.deadline = None
+        self.woke = None  # when the current frame's work started
+        self.degraded = False
+        self.detecting = True  # whether detection runs on the current frame
+        self.consecutive_overruns = 0
+        self.consecutive_fits = 0
+        self.frame_index = 0
+
+        self.frames = 0
+        self.overruns = 0
+        self.overrun_seconds_max = 0.0
+        self.busy_seconds_total = 0.0
+        self.busy_seconds_max = 0.0
+        self.skipped_detections = 0
+
+    def should_detect(self) -> bool:
+        """whether to run detection on the frame about to be processed"""
+        self.frame_index += 1
+        self.detecting = not self.degraded or self.frame_index % self.detect_every == 0
+        if not self.detecting:
+            self.skipped_detections += 1
+        return self.detecting
+
+    def wait(self):
+        """call once per frame after it has been processed, sleeps until the next frame is due"""
+        now = time.monotonic()
+        if self.woke is not None:
+            busy = now - self.woke
+            self.frames += 1
+            self.busy_seconds_total += busy
+            self.busy_seconds_max = max(self.busy_seconds_max, busy)
+            if self.detecting:
+                self._track_load(busy)
+
+        if self.interval == 0:
+            self.woke = now
+            return
+
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += self.interval
+        if now > self.deadline:
+            late = now - self.deadline
+            self.overruns += 1
+            self.overrun_seconds_max = max(self.overrun_seconds_max, late)
+            self.consecutive_overruns += 1
+            logger.debug("frame overran its deadline by %.1f ms", late * 1000)
+            self.deadline = now
+        else:
+            self.consecutive_overruns = 0
+            time.sleep(self.deadline - now)
+
+        if self.degrade and not self.degraded and self.consecutive_overruns >= self.degrade_after:
+            logger.warning("%d frames in a row overran the %.3f s interval, detecting on every %d frames",
+                           self.consecutive_overruns, self.interval, self.detect_every)
+            self.degraded = True
+            self.consecutive_fits = 0
+        self.woke = time.monotonic()
+
+    def _track_load(self, busy: float):
+        """a detecting frame that fits in 80% of the interval counts towards leaving degraded mode"""
+        if not self.degraded:
+            return
+        if busy <= 0.8 * self.interval:
+            self.consecutive_fits += 1
+            if self.consecutive_fits >= self.recover_after:
+                logger.info("pipeline is keeping up again, detecting on every frame")
+                self.degraded = False
+                self.consecutive_overruns = 0
+        else:
+            self.consecutive_fits = 0
+
+    def stats(self) -> dict:
+        return {
+            'interval': self.interval,
+            'frames': self.frames,
+            'overruns': self.overruns,
+            'overrun_ms_max': self.overrun_seconds_max * 1000,
+            'busy_ms_mean': self.busy_seconds_total * 1000 / self.frames if self.frames else 0,
+            'busy_ms_max': self.busy_seconds_max * 1000,
+            'degraded': self.degraded,
+            'skipped_detections': self.skipped_detections,
+        }
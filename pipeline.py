@@ -0,0 +1,231 @@
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger("pipeline")
+logger.setLevel(logging.INFO)
+
+# passed down the stages when the source runs out
+END = object()
+
+
+class BoundedQueue:
+    """
+    A queue between two stages. When it is full the policy decides what happens:
+
+    block: the producer waits for room
+    drop-oldest: the oldest queued item is thrown away, so the consumer always works on recent frames
+    drop-newest: the new item is thrown away
+
+    on_drop, if given, is called with every item that is thrown away.
+    """
+    POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, name: str, size: int = 2, policy: str = 'block', on_drop=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown queue policy '{policy}' for {name}, expected one of {list(self.POLICIES)}")
+        if size < 1:
+            raise ValueError(f"queue {name} needs room for at least one item")
+        self.name = name
+        self.size = size
+        self.policy = policy
+        self.on_drop = on_drop
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        self._put = 0
+        self._dropped = 0
+        self._depth_max = 0
+
+    def put(self, item) -> bool:
+        """returns False if the item, or the one it replaced, was dropped"""
+        with self._condition:
+            self._put += 1
+            dropped = False
+            if item is END:
+                # the end always goes through, after everything queued before it
+                self._items.append(item)
+            else:
+                while len(self._items) >= self.size:
+                    if self.policy == 'drop-newest':
+                        self._dropped += 1
+                        self._drop(item)
+                        return False
+                    if self.policy == 'drop-oldest' and self._items[0] is not END:
+                        self._drop(self._items.popleft())
+                        self._dropped += 1
+                        dropped = True
+                        break
+                    self._condition.wait()
+                self._items.append(item)
+            self._depth_max = max(self._depth_max, len(self._items))
+            self._condition.notify_all()
+            return not dropped
+
+    def _drop(self, item):
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def get(self):
+        with self._condition:
+            while not self._items:
+                self._condition.wait()
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'policy': self.policy,
+                'size': self.size,
+                'depth': len(self._items),
+                'depth_max': self._depth_max,
+                'put': self._put,
+                'dropped': self._dropped,
+            }
+
+
+class Stage:
+    """a thread that takes items from inbox, runs work on them and puts what comes out (unless None) in outbox"""
+    def __init__(self, name: str, work, inbox: BoundedQueue, outbox: BoundedQueue):
+        self.name = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds_total = 0.0
+        self.busy_seconds_max = 0.0
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is END:
+                self.outbox.put(END)
+                logger.info("%s stage is done", self.name)
+                return
+            start = time.monotonic()
+            try:
+                result = self.work(item)
+            except Exception:
+                logger.exception("%s stage failed", self.name)
+                self.failed += 1
+                result = None
+            busy = time.monotonic() - start
+            self.processed += 1
+            self.busy_seconds_total += busy
+            self.busy_seconds_max = max(self.busy_seconds_max, busy)
+            if result is not None:
+                self.outbox.put(result)
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'fps': self.processed / elapsed if elapsed > 0 else 0,
+            'busy_ms_mean': self.busy_seconds_total * 1000 / self.processed if self.processed else 0,
+            'busy_ms_max': self.busy_seconds_max * 1000,
+            'inbox': self.inbox.stats(),
+        }
+
+
+class Pipeline:
+    """
+    capture -> detect -> annotate -> results(), each on its own thread with a bounded queue in front of it.
+    Persistence is the change processor's saver, which already works behind annotate.
+    Capture keeps to the pacer's interval however long the later stages take; what they cannot absorb is
+    dropped by the queue policies instead of delaying the next capture. The pacer only times capture here, so
+    its degraded mode, which skips detection when frames overrun, is turned off.
+
+    A frame whose full resolution version is deferred (info['main'], see source_images.DeferredFrame) is held
+    from capture until annotate is done with it or it is dropped, so a hit saves the frame detection fired on.
+    """
+    def __init__(self, frame_source, cp, pacer, detect_queue: int = 2, detect_policy: str = 'drop-oldest',
+                 annotate_queue: int = 4, annotate_policy: str = 'block', output_queue: int = 2,
+                 output_policy: str = 'drop-oldest'):
+        self.frame_source = frame_source
+        self.cp = cp
+        self.pacer = pacer
+        if pacer.degrade:
+            logger.info("detection load is shed by the queues, not by the pacer skipping detection")
+            pacer.degrade = False
+
+        self.detect_inbox = BoundedQueue('detect', detect_queue, detect_policy,
+                                         on_drop=lambda item: self._release_main(item[1]))
+        self.annotate_inbox = BoundedQueue('annotate', annotate_queue, annotate_policy,
+                                           on_drop=lambda item: self._release_main(item[2]))
+        self.output = BoundedQueue('output', output_queue, output_policy)
+
+        self.captured = 0
+        self.started = time.monotonic()
+        self.capture_thread = threading.Thread(target=self._capture, name='capture', daemon=True)
+        self.stages = [
+            Stage('detect', self._detect, self.detect_inbox, self.annotate_inbox),
+            Stage('annotate', self._annotate, self.annotate_inbox, self.output),
+        ]
+        self.capture_thread.start()
+
+    def _capture(self):
+        try:
+            for frame, info in self.frame_source.yield_opencv_image_frames():
+                self.captured += 1
+                main = info.get('main')
+                if main is not None:
+                    # the source lets go of it as soon as it is asked for the next frame
+                    main.hold()
+                self.detect_inbox.put((frame, info))
+                self.pacer.wait()
+        except Exception:
+            logger.exception("capture failed")
+        finally:
+            self.detect_inbox.put(END)
+
+    @staticmethod
+    def _release_main(info: dict):
+        main = info.get('main')
+        if main is not None:
+            main.release()
+
+    def _detect(self, item):
+        frame, info = item
+        try:
+            return self.cp.detect(frame, info, detach=True), frame, info
+        except Exception:
+            self._release_main(info)
+            raise
+
+    def _annotate(self, item):
+        mrt, frame, info = item
+        # annotate takes main out of info
+        main = info.get('main')
+        try:
+            return self.cp.annotate(mrt, frame, info)
+        finally:
+            if main is not None:
+                main.release()
+
+    def results(self):
+        """yield the annotated results, ends when the source does"""
+        while True:
+            mrt = self.output.get()
+            if mrt is END:
+                return
+            yield mrt
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        rv = {
+            'capture': {
+                'captured': self.captured,
+                'fps': self.captured / elapsed if elapsed > 0 else 0,
+            },
+            'output': self.output.stats(),
+        }
+        for stage in self.stages:
+            rv[stage.name] = stage.stats()
+        return rv
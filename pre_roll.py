@@ -0,0 +1,90 @@
+import collections
+import datetime
+import logging
+
+import cv2
+import numpy as np
+
+import utilities
+
+logger = logging.getLogger("pre_roll")
+logger.setLevel(logging.INFO)
+
+
+class PreRollEntry:
+    __slots__ = ("frame", "jpeg", "timestamp", "info_dict", "nbytes")
+
+    def __init__(self, frame, jpeg, timestamp, info_dict, nbytes):
+        self.frame = frame  # None if the frame is held as JPEG
+        self.jpeg = jpeg
+        self.timestamp = timestamp
+        self.info_dict = info_dict
+        self.nbytes = nbytes
+
+
+class PreRollBuffer:
+    """
+    Ring buffer of the frames leading up to an event. It holds at most max_frames frames, no older than
+    max_seconds and no more than max_bytes in total. Frames can be shrunk by scale and held JPEG-compressed at
+    quality to keep the memory down; with neither, the buffer only keeps references to the frames.
+    """
+    def __init__(self, max_frames: int = 1, max_seconds: float = None, max_bytes: int = None,
+                 quality: int = None, scale: float = 1.0):
+        self.max_frames = max_frames
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.scale = scale
+
+        self._entries = collections.deque()
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def add(self, frame: np.ndarray, timestamp: datetime.datetime, info_dict: dict):
+        if self.max_frames <= 0:
+            return
+
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if self.quality is not None:
+            jpeg = utilities.make_jpeg_from_cv2(frame, quality=self.quality)
+            entry = PreRollEntry(None, jpeg, timestamp, info_dict, len(jpeg))
+        else:
+            entry = PreRollEntry(frame, None, timestamp, info_dict, frame.nbytes)
+
+        self._entries.append(entry)
+        self._nbytes += entry.nbytes
+        self._trim(timestamp)
+
+    def _over_budget(self, newest: datetime.datetime) -> bool:
+        if len(self._entries) > self.max_frames:
+            return True
+        if self.max_bytes is not None and self._nbytes > self.max_bytes:
+            return True
+        oldest = self._entries[0].timestamp
+        return self.max_seconds is not None and (newest - oldest).total_seconds() > self.max_seconds
+
+    def _trim(self, newest: datetime.datetime):
+        # always keep the newest frame, even if it is over budget on its own
+        while len(self._entries) > 1 and self._over_budget(newest):
+            oldest = self._entries.popleft()
+            self._nbytes -= oldest.nbytes
+
+    def drain(self):
+        """everything held, oldest first, and empty the buffer"""
+        rv = list(self._entries)
+        self._entries.clear()
+        self._nbytes = 0
+        return rv
+
+    def stats(self) -> dict:
+        return {
+            'frames': len(self._entries),
+            'bytes': self._nbytes,
+        }
@@ -0,0 +1,145 @@
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger("saver")
+logger.setLevel(logging.INFO)
+
+
+class AsyncSaver:
+    """
+    A bounded write-behind queue served by a pool of worker threads. Jobs are callables that do the
+    encoding and writing. When the queue is full the policy decides what happens:
+
+    block: the caller waits for room
+    drop-derived: a queued derived job (background, delta, ...) is thrown away to make room, or the new
+        job if it is derived itself; the caller only waits if the queue is all raw frames
+    drop-oldest: the oldest queued job is thrown away
+    """
+    POLICIES = ('block', 'drop-derived', 'drop-oldest')
+
+    def __init__(self, workers: int = 1, queue_size: int = 16, policy: str = 'block', name: str = 'saver'):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown saver policy '{policy}', expected one of {list(self.POLICIES)}")
+        if workers < 1 or queue_size < 1:
+            raise ValueError("a saver needs at least one worker and room for one job")
+
+        self.name = name
+        self.policy = policy
+        self.queue_size = queue_size
+
+        self._queue = collections.deque()  # (job, derived, time queued)
+        self._condition = threading.Condition()
+        self._busy = 0
+        self._closing = False
+
+        self._submitted = 0
+        self._written = 0
+        self._dropped = 0
+        self._failed = 0
+        self._write_seconds_total = 0.0
+        self._write_seconds_max = 0.0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job, derived: bool = False) -> bool:
+        """queue a job; returns False if it was dropped by the policy"""
+        with self._condition:
+            if self._closing:
+                raise RuntimeError(f"{self.name} is closed")
+            self._submitted += 1
+            while len(self._queue) >= self.queue_size:
+                if self.policy == 'drop-oldest':
+                    self._queue.popleft()
+                    self._dropped += 1
+                    logger.debug("%s dropped the oldest job", self.name)
+                    continue
+                if self.policy == 'drop-derived':
+                    victim = next((i for i, entry in enumerate(self._queue) if entry[1]), None)
+                    if victim is not None:
+                        del self._queue[victim]
+                        self._dropped += 1
+                        logger.debug("%s dropped a queued derived job", self.name)
+                        continue
+                    if derived:
+                        self._dropped += 1
+                        logger.debug("%s dropped a new derived job", self.name)
+                        return False
+                self._condition.wait()
+            self._queue.append((job, derived, time.monotonic()))
+            self._condition.notify_all()
+        return True
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self._closing:
+                    self._condition.wait()
+                if len(self._queue) == 0:
+                    return
+                job, derived, queued = self._queue.popleft()
+                self._busy += 1
+                self._condition.notify_all()
+
+            started = time.monotonic()
+            failed = False
+            try:
+                job()
+            except Exception:
+                failed = True
+                logger.exception("%s job failed", self.name)
+            finished = time.monotonic()
+
+            with self._condition:
+                self._busy -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._written += 1
+                write_seconds = finished - started
+                self._write_seconds_total += write_seconds
+                self._write_seconds_max = max(self._write_seconds_max, write_seconds)
+                wait_seconds = started - queued
+                self._wait_seconds_total += wait_seconds
+                self._wait_seconds_max = max(self._wait_seconds_max, wait_seconds)
+                self._condition.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """wait until everything queued so far has been written; returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self._queue) == 0 and self._busy == 0, timeout)
+
+    def close(self, timeout: float = None):
+        """write what is queued, then stop the workers"""
+        with self._condition:
+            if self._closing:
+                return
+            self._closing = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        logger.info("%s closed: %s", self.name, self.stats())
+
+    def stats(self) -> dict:
+        with self._condition:
+            done = self._written + self._failed
+            return {
+                'queue_depth': len(self._queue),
+                'queue_size': self.queue_size,
+                'busy': self._busy,
+                'submitted': self._submitted,
+                'written': self._written,
+                'dropped': self._dropped,
+                'failed': self._failed,
+                'write_ms_mean': 1000 * self._write_seconds_total / done if done else None,
+                'write_ms_max': 1000 * self._write_seconds_max,
+                'queue_wait_ms_mean': 1000 * self._wait_seconds_total / done if done else None,
+                'queue_wait_ms_max': 1000 * self._wait_seconds_max,
+            }
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import configuration
+# noinspection PyUnresolvedReferences
+import custom_logging
+
+import logging
+import signal
+import sys
+
+import change_processor
+import pacing
+import shm_ring
+import source_images
+
+configuration.configure()
+
+logger = logging.getLogger("shm_publisher")
+logger.setLevel(logging.INFO)
+
+
+def publish(input_args: dict, ring_name: str, slots: int = 8, motion_parameters: dict = None,
+            output_parameters: dict = None, pacing_parameters: dict = None):
+    """capture and detect one source, publishing every result into the frame ring ring_name"""
+    if pacing_parameters is None:
+        pacing_parameters = configuration.settings.get('pacing', {})
+
+    cp = change_processor.ChangeProcessor(motion_parameters=motion_parameters, output_parameters=output_parameters)
+    # the ring carries the threshold plane for the diff feeds
+    cp.add_plane_consumer('threshold_after_erode')
+    pacer = pacing.FramePacer(input_args.get('delay', 10), **pacing_parameters)
+
+    logger.info("Creating image source with %s", input_args)
+    frame_source = source_images.fetch_frame_source(**input_args)
+
+    # run the finally clause below on a plain kill too, so the ring gets unlinked
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    ring = None
+    try:
+        for frame, info in frame_source.yield_opencv_image_frames():
+            if pacer.should_detect():
+                mrt = cp.process_frame(frame, info)
+            else:
+                mrt = cp.pass_through(frame, info)
+            if ring is None:
+                ring = shm_ring.FrameRing.create(ring_name, mrt.frame2.shape, slots=slots)
+            ring.publish(mrt)
+            logger.debug("published %s", ring.latest())
+            pacer.wait()
+    finally:
+        if ring is not None:
+            ring.close()
+        cp.close()
+
+
+def main():
+    """capture and detect, publishing every result into the frame ring for web_worker.py processes to serve"""
+    shm_args = configuration.settings.get('shm', {})
+    publish(configuration.settings.get('input', {}), shm_args.get('name', 'jomo'), slots=shm_args.get('slots', 8))
+
+
+if __name__ == '__main__':
+    main()
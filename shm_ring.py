@@ -0,0 +1,272 @@
+import datetime
+import logging
+import time
+
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import jpeg_cache
+
+logger = logging.getLogger("shm_ring")
+logger.setLevel(logging.INFO)
+
+MAGIC = 0x4f4d4f4a  # "JOMO"
+VERSION = 1
+MAX_BOXES = 60
+
+RING_HEADER = np.dtype([
+    ("magic", "<u4"),
+    ("version", "<u4"),
+    ("slots", "<u4"),
+    ("max_boxes", "<u4"),
+    ("slot_size", "<u8"),
+    ("frame_capacity", "<u8"),
+    ("plane_capacity", "<u8"),
+    ("latest", "<u8"),  # sequence number of the newest complete slot, 0 before the first one
+])
+RING_HEADER_SIZE = 64
+
+SLOT_HEADER = np.dtype([
+    ("seq_begin", "<u8"),  # set before the slot is written
+    ("seq_end", "<u8"),  # set after the slot is written, the slot is consistent while both are equal
+    ("timestamp", "<f8"),  # capture time, seconds since the epoch
+    ("contour_area_ratio", "<f8"),
+    ("frame_shape", "<u4", (3,)),
+    ("plane_shape", "<u4", (2,)),  # all 0 when the threshold plane was not published
+    ("boxes_count", "<u4"),
+    ("boxes", "<i4", (MAX_BOXES, 4)),
+])
+SLOT_HEADER_SIZE = 1024
+
+assert RING_HEADER.itemsize <= RING_HEADER_SIZE
+assert SLOT_HEADER.itemsize <= SLOT_HEADER_SIZE
+
+
+def remove(name: str):
+    """unlink a ring left over from an earlier run, so nobody attaches to it instead of the new one"""
+    try:
+        stale = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    logger.warning("removing existing shared memory '%s'", name)
+    stale.close()
+    stale.unlink()
+
+
+class RingResult:
+    """
+    A result read back from the ring, looks enough like MotionDetector1Result for the stream generators.
+    Planes are copied out of the slot the first time they are asked for, None if the writer has reused the
+    slot by then.
+    """
+    PLANES = ("frame2", "threshold_after_erode")
+
+    def __init__(self, ring, sequence: int, header: np.ndarray):
+        self.ring = ring
+        self.sequence = sequence
+        self.timestamp = datetime.datetime.fromtimestamp(float(header["timestamp"]), datetime.timezone.utc)
+        self.contour_area_ratio = float(header["contour_area_ratio"])
+        self.bounding_rects = [tuple(int(v) for v in box) for box in header["boxes"][:int(header["boxes_count"])]]
+        self._shapes = {
+            "frame2": tuple(int(v) for v in header["frame_shape"]),
+            "threshold_after_erode": tuple(int(v) for v in header["plane_shape"]),
+        }
+        self._planes = {}
+        self._jpeg_cache = jpeg_cache.JpegCache()
+
+    def get_plane(self, name: str):
+        plane = self._planes.get(name)
+        if plane is None:
+            shape = self._shapes.get(name)
+            if shape is None or 0 in shape:
+                return None
+            plane = self.ring.copy_plane(self.sequence, name, shape)
+            if plane is None:
+                return None
+            self._planes[name] = plane
+        return plane
+
+    @property
+    def frame2(self):
+        return self.get_plane("frame2")
+
+    @property
+    def threshold_after_erode(self):
+        return self.get_plane("threshold_after_erode")
+
+    def get_jpeg(self, plane: str = "frame2", quality: int = 95, scale: float = 1.0):
+        """the plane as JPEG bytes, encoded once per result, None if it is not available"""
+        image = self.get_plane(plane)
+        if image is None:
+            return None
+        return self._jpeg_cache.get(image, (plane, quality, scale))
+
+    def __str__(self):
+        return f"RingResult({self.sequence}, {self.timestamp.isoformat()}, {len(self.bounding_rects)} boxes)"
+
+
+class FrameRing:
+    """
+    A ring of frame slots in shared memory. One process (the one that captures and detects) creates it and
+    publishes results, any number of other processes attach and read them without the frames going through a pipe.
+    Each slot is guarded by a sequence lock: readers copy a slot out and then check that the writer has not
+    started on it again in the meantime.
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((), dtype=RING_HEADER, buffer=shm.buf)
+        if self.header["magic"] != MAGIC or self.header["version"] != VERSION:
+            raise ValueError(f"shared memory '{shm.name}' does not hold a version {VERSION} frame ring")
+        self.slots = int(self.header["slots"])
+        self.slot_size = int(self.header["slot_size"])
+        self.frame_capacity = int(self.header["frame_capacity"])
+        self.plane_capacity = int(self.header["plane_capacity"])
+        self.published = 0
+        self.skipped = 0
+        self.torn = 0
+
+    @classmethod
+    def create(cls, name: str, frame_shape: tuple, slots: int = 8):
+        """create the ring for frames of up to frame_shape, replacing a ring left over from an earlier run"""
+        frame_capacity = int(np.prod(frame_shape))
+        plane_capacity = int(frame_shape[0] * frame_shape[1])
+        slot_size = SLOT_HEADER_SIZE + frame_capacity + plane_capacity
+        slot_size = -(-slot_size // 64) * 64
+        size = RING_HEADER_SIZE + slots * slot_size
+
+        remove(name)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:size] = bytes(size)
+        header = np.ndarray((), dtype=RING_HEADER, buffer=shm.buf)
+        header["slots"] = slots
+        header["max_boxes"] = MAX_BOXES
+        header["slot_size"] = slot_size
+        header["frame_capacity"] = frame_capacity
+        header["plane_capacity"] = plane_capacity
+        header["version"] = VERSION
+        header["magic"] = MAGIC
+        del header
+        logger.info("created frame ring '%s', %d slots of %d bytes", name, slots, slot_size)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str):
+        """attach to a ring some other process created, raises FileNotFoundError if there is none"""
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before 3.13 attaching registers the segment with the resource tracker, which would unlink it
+            # when this process exits
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, owner=False)
+
+    def _slot(self, sequence: int):
+        offset = RING_HEADER_SIZE + ((sequence - 1) % self.slots) * self.slot_size
+        header = np.ndarray((), dtype=SLOT_HEADER, buffer=self.shm.buf, offset=offset)
+        return header, offset + SLOT_HEADER_SIZE
+
+    def _frame_view(self, data_offset: int, shape: tuple):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=data_offset)
+
+    def _plane_view(self, data_offset: int, shape: tuple):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=data_offset + self.frame_capacity)
+
+    def publish(self, mrt) -> bool:
+        """write frame2, the threshold plane and the boxes of a result into the next slot"""
+        frame = mrt.frame2
+        plane = mrt.get_plane("threshold_after_erode") if mrt.derived_data_is_valid else None
+        if frame.dtype != np.uint8 or frame.nbytes > self.frame_capacity or frame.ndim != 3:
+            logger.error("frame %s %s does not fit the ring", frame.shape, frame.dtype)
+            self.skipped += 1
+            return False
+        if plane is not None and (plane.dtype != np.uint8 or plane.nbytes > self.plane_capacity):
+            plane = None
+
+        sequence = int(self.header["latest"]) + 1
+        header, data_offset = self._slot(sequence)
+        header["seq_begin"] = sequence
+
+        self._frame_view(data_offset, frame.shape)[...] = frame
+        header["frame_shape"] = frame.shape
+        if plane is None:
+            header["plane_shape"] = (0, 0)
+        else:
+            self._plane_view(data_offset, plane.shape)[...] = plane
+            header["plane_shape"] = plane.shape
+
+        timestamp = mrt.timestamp
+        if isinstance(timestamp, datetime.datetime):
+            timestamp = timestamp.timestamp()
+        header["timestamp"] = time.time() if timestamp is None else timestamp
+        header["contour_area_ratio"] = mrt.contour_area_ratio or 0
+        boxes = (mrt.bounding_rects or [])[:MAX_BOXES]
+        header["boxes_count"] = len(boxes)
+        if boxes:
+            header["boxes"][:len(boxes)] = boxes
+
+        header["seq_end"] = sequence
+        self.header["latest"] = sequence
+        self.published += 1
+        return True
+
+    def latest(self) -> int:
+        return int(self.header["latest"])
+
+    def read(self, sequence: int):
+        """the result with this sequence number, None if the slot has been reused since"""
+        header, _ = self._slot(sequence)
+        if int(header["seq_end"]) != sequence:
+            return None
+        snapshot = header.copy()
+        if int(header["seq_begin"]) != sequence:
+            self.torn += 1
+            return None
+        return RingResult(self, sequence, snapshot)
+
+    def copy_plane(self, sequence: int, name: str, shape: tuple):
+        header, data_offset = self._slot(sequence)
+        if int(header["seq_end"]) != sequence:
+            return None
+        if name == "frame2":
+            plane = self._frame_view(data_offset, shape).copy()
+        else:
+            plane = self._plane_view(data_offset, shape).copy()
+        if int(header["seq_begin"]) != sequence:
+            self.torn += 1
+            return None
+        return plane
+
+    def results(self, poll_interval: float = 0.005):
+        """yield every new result as it is published, skipping to the newest one if the reader falls behind"""
+        last = 0
+        while True:
+            latest = self.latest()
+            if latest == last:
+                time.sleep(poll_interval)
+                continue
+            if latest < last:
+                logger.info("frame ring '%s' went back from %d to %d, writer restarted?", self.shm.name, last, latest)
+            last = latest
+            result = self.read(latest)
+            if result is not None:
+                yield result
+
+    def stats(self) -> dict:
+        return {
+            'name': self.shm.name,
+            'slots': self.slots,
+            'slot_size': self.slot_size,
+            'latest': self.latest(),
+            'published': self.published,
+            'skipped': self.skipped,
+            'torn': self.torn,
+        }
+
+    def close(self):
+        self.header = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
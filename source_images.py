@@ -1,5 +1,6 @@
 import logging
 import platform
+import threading
 
 from pathlib import Path
 from typing import Generator, Tuple, Dict
@@ -27,6 +28,57 @@ class FrameSource:
         pass
 
 
+class DeferredFrame:
+    """
+    A frame a source hands over without building it, e.g. the full resolution image next to the smaller one
+    that detection runs on. make() builds it from data the source is holding. The source starts with one hold
+    on that data; anybody who needs it to stay around past the next frame (e.g. a staged pipeline) takes
+    another with hold(), and every hold is given back with release(). When the last one is, on_release lets
+    the data go, and from then on capture(), if there is one, takes a new frame instead. It is built at most once.
+    """
+    def __init__(self, make, capture=None, on_release=None):
+        self._make = make
+        self._capture = capture
+        self._on_release = on_release
+        self._holds = 1
+        self._frame = None
+        self._lock = threading.Lock()
+        # True when the frame had to be captured again because nobody asked for it in time
+        self.captured_later = False
+
+    def get(self):
+        with self._lock:
+            if self._frame is None:
+                if self._make is not None:
+                    self._frame = self._make()
+                elif self._capture is not None:
+                    self._frame = self._capture()
+                    self.captured_later = True
+                self._capture = None
+            return self._frame
+
+    @property
+    def ready(self) -> bool:
+        return self._frame is not None
+
+    def hold(self):
+        """keep the source's data until a matching release()"""
+        with self._lock:
+            self._holds += 1
+
+    def release(self):
+        with self._lock:
+            if self._holds == 0:
+                return
+            self._holds -= 1
+            if self._holds > 0:
+                return
+            self._make = None
+            on_release, self._on_release = self._on_release, None
+        if on_release is not None:
+            on_release()
+
+
 def fetch_frame_source(source: str = None, **kwargs) -> FrameSource:
     rv = None
 
@@ -43,6 +95,10 @@ def fetch_frame_source(source: str = None, **kwargs) -> FrameSource:
             import source_images_from_files
             rv = source_images_from_files.FilesFrameSource(strict_args = False, **kwargs)
 
+        if source.lower() == 'video-file':
+            import source_images_from_video_file
+            rv = source_images_from_video_file.VideoFileFrameSource(strict_args = False, **kwargs)
+
     if rv is None:
         raise AttributeError("no input source has been specified")
 
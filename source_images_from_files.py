@@ -1,5 +1,9 @@
+import collections
+import concurrent.futures
 import datetime
+import heapq
 import logging
+import os
 import re
 import time
 
@@ -11,13 +15,67 @@ import cv2
 from PIL import Image
 import numpy as np
 
+import frame_cache
 import source_images
 import utilities
 
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class _PollingWatcher:
+    """
+    Notices files added to a directory by watching the directory's mtime, which changes whenever an entry is
+    added or removed. The directory is only listed again when it has changed, and only wanted names that sort
+    after the last one handed out are returned, so the names must sort in the order the files arrive, as the
+    timestamped names cameras write do. A file whose name sorts before one already seen is not noticed.
+    """
+    def __init__(self, directory: Path, poll_interval: float, wanted, after: str = ''):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.wanted = wanted
+        self.after = after
+        self.mtime_ns = None
+
+    def changed(self, timeout: float) -> list:
+        """names that are new, waiting up to timeout for the directory to change"""
+        deadline = time.monotonic() + timeout
+        while True:
+            mtime_ns = os.stat(self.directory).st_mtime_ns
+            if mtime_ns != self.mtime_ns:
+                # an entry added in the same clock tick as the listing would not change the mtime again,
+                # so a directory that changed very recently is listed once more next time
+                recent = time.time_ns() - mtime_ns < 2_000_000_000
+                self.mtime_ns = None if recent else mtime_ns
+                with os.scandir(self.directory) as entries:
+                    names = [entry.name for entry in entries if entry.name > self.after and self.wanted(entry.name)]
+                if names:
+                    self.after = max(names)
+                    return names
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            time.sleep(min(self.poll_interval, remaining))
+
+
+class _InotifyWatcher:
+    """notices files added to a directory through inotify, once they have been closed or moved in"""
+    def __init__(self, directory: Path):
+        self.inotify = inotify_simple.INotify()
+        self.inotify.add_watch(directory, inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO)
+
+    def changed(self, timeout: float) -> list:
+        return [event.name for event in self.inotify.read(timeout=int(timeout * 1000))]
+
 
 class FilesFrameSource(source_images.FrameSource):
     def __init__(self, forever: bool = True, log_level: int | str = logging.INFO, directory: str = None,
-                 glob : Iterable[str] | str = '*', strict_args = True, **kwargs):
+                 glob : Iterable[str] | str = '*', prefetch: int = 0, decode_workers: int = 0,
+                 decode_scale: float = 1.0, cache_bytes: int = 0, cache_directory: str = None, follow: bool = False,
+                 follow_existing: bool = False, poll_interval: float = 1.0, settle_time: float = 0.5,
+                 strict_args = True, **kwargs):
         super().__init__(log_level)
 
         if strict_args and len(kwargs) > 0:
@@ -34,6 +92,34 @@ class FilesFrameSource(source_images.FrameSource):
 
         self.forever = forever
 
+        # with prefetch and/or decode_workers files are decoded ahead of the consumer by a thread pool,
+        # at most prefetch of them at a time; decoding releases the GIL
+        if decode_workers > 0 and prefetch <= 0:
+            prefetch = 2 * decode_workers
+        if prefetch > 0 and decode_workers <= 0:
+            decode_workers = min(prefetch, os.cpu_count() or 1)
+        self.prefetch = prefetch
+        self.decode_workers = decode_workers
+        # frames come out this much smaller; JPEGs are reduced by 1/2, 1/4 or 1/8 while they are decoded,
+        # whatever is left over is done with a resize
+        if not 0 < decode_scale <= 1:
+            raise ValueError(f"decode_scale must be in (0, 1], not {decode_scale}")
+        self.decode_scale = decode_scale
+        # decoded frames are kept memory-mapped for later passes when cache_bytes is set, mostly useful with forever
+        self.cache = frame_cache.MappedFrameCache(cache_bytes, cache_directory) if cache_bytes > 0 else None
+        self.date_re = re.compile(r"(\d{8}-\d{6})\.")
+        self.local_tz = ZoneInfo('localtime')
+
+        # with follow the directory is watched for new files, which are yielded in name order as they arrive,
+        # instead of going over the list below again; the files already there are only yielded with follow_existing
+        self.follow = follow
+        self.follow_existing = follow_existing
+        self.poll_interval = poll_interval
+        # without inotify a new file is only read once it has not been modified for this long
+        self.settle_time = settle_time
+        self.globs = globs
+        self.directory = Path(directory)
+
         p = Path(directory)
         file_paths = []
         for g in globs:
@@ -67,6 +153,70 @@ class FilesFrameSource(source_images.FrameSource):
         cv2.putText(frame, text, text_origin, font, font_scale, color, thickness, cv2.LINE_AA)
         return frame
 
+    def load(self, file_path: Path):
+        """the decoded frame and its info, None if the file is not an image"""
+        if not file_path.is_file():
+            return None
+        info = {'path': file_path}
+        m = self.date_re.search(str(file_path))
+        if m:
+            dt_s = m.group(1)
+            dt = datetime.datetime.strptime(dt_s, '%Y%m%d-%H%M%S')
+            dt = dt.astimezone(self.local_tz)
+            info['timestamp'] = dt
+
+        if self.cache is not None:
+            frame = self.cache.get(file_path, self.decode_scale)
+            if frame is not None:
+                return frame, info
+
+        try:
+            # Open the image using Pillow (PIL)
+            with Image.open(file_path) as img:
+                size = None
+                if self.decode_scale != 1.0:
+                    size = (max(1, round(img.width * self.decode_scale)), max(1, round(img.height * self.decode_scale)))
+                    # picks the smallest DCT scaling that is still at least size, a no-op for anything but JPEG
+                    img.draft('RGB', size)
+                frame = utilities.make_cv2_from_pillow(img)
+        except IOError:
+            # Handle cases where a file might not be a valid image
+            self.logger.error(f"Skipping non-image file: {file_path}")
+            return None
+        if size is not None and (frame.shape[1], frame.shape[0]) != size:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+        if self.cache is not None:
+            self.cache.put(file_path, frame, self.decode_scale)
+        return frame, info
+
+    def load_all(self, file_paths: list):
+        """load() for each file in order, decoding up to prefetch files ahead on decode_workers threads"""
+        if self.prefetch <= 0:
+            for file_path in file_paths:
+                yield self.load(file_path)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.decode_workers,
+                                                   thread_name_prefix='decode') as executor:
+            window = collections.deque()
+            paths = iter(file_paths)
+            try:
+                for file_path in paths:
+                    window.append(executor.submit(self.load, file_path))
+                    if len(window) >= self.prefetch:
+                        break
+                while window:
+                    result = window.popleft().result()
+                    # keep the window full, the slot that was just taken is what bounds the memory used
+                    for file_path in paths:
+                        window.append(executor.submit(self.load, file_path))
+                        break
+                    yield result
+            finally:
+                for future in window:
+                    future.cancel()
+
     def yield_opencv_image_frames(self) -> Generator[Tuple[np.ndarray, Dict], None, None]:
         """
         A generator function that iterates over image files in a directory
@@ -76,28 +226,16 @@ class FilesFrameSource(source_images.FrameSource):
         An image frame as a opencv image.
         """
         self.logger.info("starting yield_pillow_image_frames")
-        date_re = re.compile(r"(\d{8}-\d{6})\.")
-        local_tz = ZoneInfo('localtime')
+        if self.follow:
+            yield from self.follow_directory()
+            return
         while True:
             yielded_something = False
-            for file_path in self.file_paths:
-                if file_path.is_file():
-                    try:
-                        # Open the image using Pillow (PIL)
-                        with Image.open(file_path) as img:
-                            info = {'path': file_path}
-                            m = date_re.search(str(file_path))
-                            if m:
-                                dt_s = m.group(1)
-                                dt = datetime.datetime.strptime(dt_s, '%Y%m%d-%H%M%S')
-                                dt = dt.astimezone(local_tz)
-                                info['timestamp'] = dt
-                            self.logger.debug("yielding image %s %s", file_path, info)
-                            yield utilities.make_cv2_from_pillow(img), info
-                            yielded_something = True
-                    except IOError:
-                        # Handle cases where a file might not be a valid image
-                        self.logger.error(f"Skipping non-image file: {file_path}")
+            for frame_and_info in self.load_all(self.file_paths):
+                if frame_and_info is not None:
+                    self.logger.debug("yielding image %s", frame_and_info[1])
+                    yield frame_and_info
+                    yielded_something = True
 
             if not yielded_something:
                 self.logger.debug("yielding error frame")
@@ -110,6 +248,64 @@ class FilesFrameSource(source_images.FrameSource):
         self.logger.info("exiting yield_pillow_image_frames")
 
 
+    def follow_directory(self) -> Generator[Tuple[np.ndarray, Dict], None, None]:
+        """yield files as they are added to the directory, never going over the whole directory again"""
+        wanted = self.wanted
+        existing = [file_path.name for file_path in self.file_paths if file_path.parent == self.directory]
+        if inotify_simple is not None:
+            watcher = _InotifyWatcher(self.directory)
+            settle_time = 0
+            self.logger.info("following %s with inotify", self.directory)
+        else:
+            watcher = _PollingWatcher(self.directory, self.poll_interval, wanted, max(existing, default=''))
+            settle_time = self.settle_time
+            self.logger.warning("inotify_simple is not installed, following %s by polling every %s s; "
+                                "only files that sort after the ones already there are noticed",
+                                self.directory, self.poll_interval)
+
+        seen = set(existing)
+        pending = []  # heap of names waiting to be read
+        if self.follow_existing:
+            pending = list(existing)
+            heapq.heapify(pending)
+        # files that turned up between the glob and the watch starting
+        for name in watcher.changed(0) if inotify_simple is None else os.listdir(self.directory):
+            if name not in seen:
+                seen.add(name)
+                if wanted(name):
+                    heapq.heappush(pending, name)
+
+        while True:
+            timeout = self.poll_interval
+            while pending:
+                file_path = self.directory / pending[0]
+                if settle_time > 0:
+                    try:
+                        age = time.time() - file_path.stat().st_mtime
+                    except FileNotFoundError:
+                        heapq.heappop(pending)
+                        continue
+                    if age < settle_time:
+                        # probably still being written; later files wait for it, to keep them in order
+                        timeout = min(timeout, settle_time - age)
+                        break
+                heapq.heappop(pending)
+                frame_and_info = self.load(file_path)
+                if frame_and_info is not None:
+                    self.logger.debug("yielding image %s", frame_and_info[1])
+                    yield frame_and_info
+
+            for name in watcher.changed(timeout):
+                if name in seen:
+                    continue
+                seen.add(name)
+                if wanted(name):
+                    heapq.heappush(pending, name)
+
+    def wanted(self, name: str) -> bool:
+        """whether a file name matches one of the globs"""
+        return any(Path(name).match(g) for g in self.globs)
+
 
 # Example Usage:
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 import datetime
 import logging
+import threading
 import time
 
 from typing import Generator, Tuple, Dict
@@ -14,9 +15,70 @@ logger = logging.getLogger("source_opencv")
 logger.setLevel(logging.INFO)
 
 
+class _Grabber:
+    """
+    Calls grab() on a capture in a thread of its own, so frames leave the driver's buffer as they arrive without
+    being decoded. retrieve() decodes only the frame a consumer asks for: the next one to be grabbed after it
+    asks, with the time it was grabbed and how many frames were grabbed since the consumer's previous one.
+    """
+    def __init__(self, cap: cv2.VideoCapture):
+        self.cap = cap
+        self.condition = threading.Condition()
+        self.running = True
+        self.sequence = 0  # frames grabbed so far
+        self.grabbed_at = None
+        self.failures = 0
+        self.waiting = False  # a consumer wants the next frame
+        self.retrieved = 0  # sequence number of the last frame retrieved
+        self.thread = threading.Thread(target=self._run, name="grab", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            ok = self.cap.grab()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            with self.condition:
+                if ok:
+                    self.sequence += 1
+                    self.grabbed_at = now
+                else:
+                    self.failures += 1
+                self.condition.notify_all()
+                # a waiting consumer retrieves this frame before grab() replaces it
+                while self.running and ok and self.waiting:
+                    self.condition.wait()
+            if not ok:
+                logger.error("v4l2 grab error")
+                time.sleep(0.01)
+
+    def retrieve(self):
+        """(image, timestamp, dropped) for the next frame grabbed, image is None if it could not be decoded"""
+        with self.condition:
+            after = self.sequence
+            self.waiting = True
+            try:
+                self.condition.wait_for(lambda: self.sequence > after or not self.running)
+                if not self.running:
+                    return None, None, 0
+                # the grab thread is waiting for us, so the capture is ours until we return
+                ok, image = self.cap.retrieve()
+                dropped = max(0, self.sequence - self.retrieved - 1) if self.retrieved else 0
+                self.retrieved = self.sequence
+                return (image if ok else None), self.grabbed_at, dropped
+            finally:
+                self.waiting = False
+                self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(5)
+
+
 class OpenCVCameraImageSource(source_images.FrameSource):
-    def __init__(self, log_level: int | str = logging.INFO, camera_name: str = None, resolution=None, strict_args=True,
-                 **kwargs):
+    def __init__(self, log_level: int | str = logging.INFO, camera_name: str = None, resolution=None,
+                 grab_thread: bool = False, strict_args=True, **kwargs):
         super().__init__(log_level)
 
         if strict_args and len(kwargs) > 0:
@@ -39,6 +101,10 @@ class OpenCVCameraImageSource(source_images.FrameSource):
         # reduce # of buffers, so we don't need to flush so many
         self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
+        # with grab_thread a background thread keeps grabbing and only the frames that are asked for are decoded,
+        # instead of reading (and decoding) until a read is slow enough to be a fresh frame
+        self.grab_thread = grab_thread
+
     def yield_opencv_image_frames(self) -> Generator[Tuple[np.ndarray, Dict], None, None]:
         """
         A generator function that yields opencv images from the opencv camera
@@ -47,6 +113,9 @@ class OpenCVCameraImageSource(source_images.FrameSource):
         An image frame as an opencv image.
         """
         logger.info("starting yield_pillow_image_frames")
+        if self.grab_thread:
+            yield from self.yield_grabbed_frames()
+            return
         try:
             while True:
                 dropped = 0
@@ -70,3 +139,21 @@ class OpenCVCameraImageSource(source_images.FrameSource):
             self.logger.info("releasing cap")
             self.cap.release()
             self.cap = None
+
+    def yield_grabbed_frames(self) -> Generator[Tuple[np.ndarray, Dict], None, None]:
+        grabber = _Grabber(self.cap)
+        try:
+            while True:
+                before = time.time()
+                cv2_image, timestamp, dropped = grabber.retrieve()
+                interval = time.time() - before
+                if cv2_image is None:
+                    logging.error("v4l2 retrieve error")
+                    continue
+                yield cv2_image, {'timestamp': timestamp, 'interval': interval, 'dropped': dropped,
+                                  'grab_failures': grabber.failures}
+        finally:
+            grabber.stop()
+            self.logger.info("releasing cap")
+            self.cap.release()
+            self.cap = None
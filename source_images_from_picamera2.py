@@ -1,12 +1,11 @@
 import datetime
+import functools
 import logging
 import time
 
 from typing import Generator, Tuple, Dict
 
-from picamera2 import Picamera2, Preview
-from libcamera import Transform
-
+import cv2
 import numpy as np
 
 import configuration
@@ -17,13 +16,33 @@ logger.setLevel(logging.INFO)
 
 
 class PiCamera2FrameSource(source_images.FrameSource):
-    def __init__(self, log_level: int | str = logging.INFO, vflip: bool = None, hflip: bool = None, resolution=None, strict_args = True, **kwargs):
+    """
+    Frames from a Pi camera. With dual_stream the camera runs a video configuration with a small YUV420 lores
+    stream next to main: the lores frames are what is yielded and detected on, and each one comes with the
+    matching main frame as info['main'], a source_images.DeferredFrame that is only turned into an array if
+    somebody asks for it (a hit, or a client of the full resolution feed). The request is held until the next
+    frame is wanted, or longer by whoever takes a hold() on info['main'] (the staged pipeline holds it until
+    annotate is done); asked for any later than that, a new main frame is captured instead. Each hold keeps one
+    of the camera's buffers, so with a pipeline, buffer_count should have room for its queues.
+
+    camera is a Picamera2 to use instead of opening one, e.g. a stand-in for testing.
+    """
+    def __init__(self, log_level: int | str = logging.INFO, vflip: bool = None, hflip: bool = None, resolution=None,
+                 dual_stream: bool = False, lores_resolution=(640, 480), buffer_count: int = None, camera=None,
+                 strict_args = True, **kwargs):
         super().__init__(log_level)
 
         if strict_args and len(kwargs) > 0:
             raise TypeError(f"unexpected arguments: {kwargs}")
 
-        self.picam2 = Picamera2()
+        if camera is None:
+            from picamera2 import Picamera2
+            camera = Picamera2()
+        self.picam2 = camera
+        self.dual_stream = dual_stream
+        self.lores_size = tuple(lores_resolution)
+        if dual_stream and (self.lores_size[0] % 2 or self.lores_size[1] % 2):
+            raise ValueError(f"lores_resolution {self.lores_size} must have an even width and height for YUV420")
 
         capture_config_parameters = {}
 
@@ -33,6 +52,7 @@ class PiCamera2FrameSource(source_images.FrameSource):
         if hflip is not None:
             transform_parameters['hflip'] = hflip
         if len(transform_parameters) > 0:
+            from libcamera import Transform
             capture_config_parameters['transform'] = Transform(**transform_parameters)
 
         if resolution is not None:
@@ -43,9 +63,27 @@ class PiCamera2FrameSource(source_images.FrameSource):
         # print(json.dumps(picam2.sensor_modes, indent=1, default=lambda o: o.__dict__, sort_keys=True))
 
         logger.info ("Configuring picamera with %s", capture_config_parameters)
-        capture_config = self.picam2.create_still_configuration(**capture_config_parameters)
+        if dual_stream:
+            # RGB888 comes out in OpenCV's BGR order
+            capture_config_parameters['main'] = dict(capture_config_parameters.get('main', {}), format='RGB888')
+            capture_config_parameters['lores'] = {'size': self.lores_size, 'format': 'YUV420'}
+            if buffer_count is not None:
+                capture_config_parameters['buffer_count'] = buffer_count
+            capture_config = self.picam2.create_video_configuration(**capture_config_parameters)
+        else:
+            capture_config = self.picam2.create_still_configuration(**capture_config_parameters)
         self.picam2.configure(capture_config)
 
+    def lores_frame(self, request) -> np.ndarray:
+        """the lores stream as a BGR image; rows of the YUV420 array may be padded out to the stride"""
+        yuv = request.make_array("lores")
+        frame = cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+        return frame[:, :self.lores_size[0]]
+
+    def _capture_main(self) -> np.ndarray:
+        logger.debug("main frame asked for after its request was released, capturing another")
+        return self.picam2.capture_array("main")
+
     def yield_opencv_image_frames(self) -> Generator[Tuple[np.ndarray, Dict], None, None]:
         """
         A generator function that yields opencv images from the Pi camera
@@ -65,14 +103,28 @@ class PiCamera2FrameSource(source_images.FrameSource):
                 now = datetime.datetime.now(datetime.timezone.utc)
                 now_ns = time.monotonic_ns()
 
-                frame = request.make_array("main")  # image from the "main" stream
+                main = None
+                if self.dual_stream:
+                    frame = self.lores_frame(request)
+                    main = source_images.DeferredFrame(functools.partial(request.make_array, "main"),
+                                                       capture=self._capture_main, on_release=request.release)
+                else:
+                    frame = request.make_array("main")  # image from the "main" stream
                 metadata = request.get_metadata()
-                request.release()  # requests must always be returned to libcamera
+                if main is None:
+                    request.release()  # requests must always be returned to libcamera
 
                 then_ns = metadata.get('SensorTimestamp', 0)
                 lag_s = (now_ns - then_ns) / 1000000000
                 then = now - datetime.timedelta(seconds=lag_s)
 
-                yield frame, {'timestamp': then}
+                if main is None:
+                    yield frame, {'timestamp': then}
+                    continue
+                try:
+                    yield frame, {'timestamp': then, 'main': main}
+                finally:
+                    # the request goes back to libcamera once nobody else is holding it
+                    main.release()
         finally:
             self.picam2.close()
@@ -0,0 +1,119 @@
+import datetime
+import logging
+import os
+import re
+
+from pathlib import Path
+from typing import Generator, Tuple, Dict
+from zoneinfo import ZoneInfo
+
+import cv2
+import numpy as np
+
+import source_images
+
+logger = logging.getLogger("source_video_file")
+logger.setLevel(logging.INFO)
+
+
+class VideoFileFrameSource(source_images.FrameSource):
+    """
+    Frames from a video file (MP4, AVI, whatever OpenCV's backends can read) as fast as they decode, for
+    replaying archived footage. Only every stride-th frame is decoded, the ones in between are just grabbed.
+    start and end are positions in the file in seconds.
+
+    A frame's timestamp is the time the file starts at plus the frame's position in the container. The start
+    is start_time if given, otherwise a yyyymmdd-hhmmss date in the file name, otherwise the file's mtime.
+    With forever the file is played again from start, with timestamps carrying on from the previous pass.
+    """
+    def __init__(self, path: str = None, log_level: int | str = logging.INFO, stride: int = 1, start: float = None,
+                 end: float = None, start_time: str | datetime.datetime = None, forever: bool = False,
+                 strict_args = True, **kwargs):
+        super().__init__(log_level)
+
+        if strict_args and len(kwargs) > 0:
+            raise TypeError(f"unexpected arguments: {kwargs}")
+
+        if path is None:
+            raise ValueError("the video-file source needs a path")
+        self.path = Path(path)
+        if not self.path.is_file():
+            raise FileNotFoundError(f"no video file at {self.path}")
+        if stride < 1:
+            raise ValueError("stride must be at least 1")
+        if start is not None and end is not None and end <= start:
+            raise ValueError(f"end ({end}) must come after start ({start})")
+        self.stride = stride
+        self.start = start
+        self.end = end
+        self.forever = forever
+        self.start_time = self.file_start_time(start_time)
+
+    def file_start_time(self, start_time) -> datetime.datetime:
+        if isinstance(start_time, str):
+            start_time = datetime.datetime.fromisoformat(start_time)
+        if start_time is None:
+            m = re.search(r"(\d{8}-\d{6})", self.path.name)
+            if m:
+                start_time = datetime.datetime.strptime(m.group(1), '%Y%m%d-%H%M%S')
+            else:
+                start_time = datetime.datetime.fromtimestamp(os.stat(self.path).st_mtime)
+        if start_time.tzinfo is None:
+            start_time = start_time.replace(tzinfo=ZoneInfo('localtime'))
+        return start_time
+
+    def open(self) -> cv2.VideoCapture:
+        cap = cv2.VideoCapture(str(self.path))
+        if not cap.isOpened():
+            raise IOError(f"cannot open {self.path} as a video")
+        if self.start:
+            # lands on the keyframe before start and decodes forward from there, depending on the backend
+            cap.set(cv2.CAP_PROP_POS_MSEC, self.start * 1000)
+        return cap
+
+    def yield_opencv_image_frames(self) -> Generator[Tuple[np.ndarray, Dict], None, None]:
+        self.logger.info("starting yield_opencv_image_frames from %s", self.path)
+        offset_ms = 0.0
+        while True:
+            cap = self.open()
+            fps = cap.get(cv2.CAP_PROP_FPS) or 0
+            frame_ms = 1000 / fps if fps > 0 else 0
+            logger.info("%s: %s frames at %.2f fps, %dx%d", self.path, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), fps,
+                        int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            grabbed = 0
+            decoded = 0
+            last_ms = None
+            try:
+                while cap.grab():
+                    index = int(cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1
+                    position_ms = cap.get(cv2.CAP_PROP_POS_MSEC)
+                    if position_ms <= 0 and index > 0 and frame_ms:
+                        # no presentation timestamp from this backend
+                        position_ms = index * frame_ms
+                    if self.start and position_ms < self.start * 1000:
+                        # decoded forward from a keyframe before start
+                        continue
+                    if self.end is not None and position_ms > self.end * 1000:
+                        break
+                    last_ms = position_ms
+                    grabbed += 1
+                    if (grabbed - 1) % self.stride:
+                        continue
+                    ok, frame = cap.retrieve()
+                    if not ok:
+                        logger.warning("%s: cannot decode frame %d", self.path, index)
+                        continue
+                    decoded += 1
+                    timestamp = self.start_time + datetime.timedelta(milliseconds=offset_ms + position_ms)
+                    yield frame, {'timestamp': timestamp, 'path': self.path, 'frame': index,
+                                  'position_ms': position_ms}
+            finally:
+                cap.release()
+            logger.info("%s: %d frames grabbed, %d decoded", self.path, grabbed, decoded)
+
+            if not self.forever or decoded == 0:
+                break
+            # the next pass carries on one frame after this one ended
+            offset_ms += last_ms - (self.start or 0) * 1000 + frame_ms
+
+        self.logger.info("exiting yield_opencv_image_frames")
@@ -0,0 +1,122 @@
+import logging
+import math
+import time
+
+from typing import Mapping
+
+from flask import request, Response
+
+import distributor
+import jpeg_cache
+
+# widths are rounded up to a multiple of this scale so clients asking for similar sizes share one encode
+SCALE_STEP = 0.05
+MIN_WIDTH = 16
+# a feed that gets no frame for this many seconds is ended, so a stalled source does not hold its thread forever
+FEED_TIMEOUT = 30
+
+
+class FeedOptions:
+    """
+    What one client asked a feed for: plane, JPEG quality, width and frame rate. Clients that end up with the
+    same (scale, quality) share one encode per frame through the result's JPEG cache.
+    """
+    __slots__ = ("plane", "quality", "width", "max_fps")
+
+    def __init__(self, plane: str, quality: int, width: int = None, max_fps: float = None):
+        self.plane = plane
+        self.quality = quality
+        self.width = width
+        self.max_fps = max_fps
+
+    @classmethod
+    def from_args(cls, args: Mapping, plane: str, quality: int):
+        """options from the width, quality and max_fps query parameters, raises ValueError for bad ones"""
+        width = args.get('width')
+        if width is not None:
+            width = int(width)
+            if width < MIN_WIDTH:
+                raise ValueError(f"width must be at least {MIN_WIDTH}")
+        quality = args.get('quality', quality)
+        quality = int(quality)
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        max_fps = args.get('max_fps')
+        if max_fps is not None:
+            max_fps = float(max_fps)
+            if not max_fps > 0:
+                raise ValueError("max_fps must be positive")
+        return cls(plane, quality, width=width, max_fps=max_fps)
+
+    @property
+    def min_interval(self) -> float:
+        return 1 / self.max_fps if self.max_fps else 0
+
+    def scale_for(self, image_width: int) -> float:
+        if self.width is None or self.width >= image_width:
+            return 1.0
+        return min(1.0, round(math.ceil(self.width / image_width / SCALE_STEP) * SCALE_STEP, 4))
+
+    def jpeg(self, mrt):
+        """the requested variant of the result, None if the plane is not available"""
+        image = getattr(mrt, self.plane)
+        if image is None:
+            return None
+        return mrt.get_jpeg(self.plane, quality=self.quality, scale=self.scale_for(image.shape[1]))
+
+
+def next_due(options: FeedOptions):
+    """earliest time the next frame may be fetched for a rate limited client, None if it is not limited"""
+    interval = options.min_interval
+    return time.time() + interval if interval else None
+
+
+def mjpeg_part(frame_jpeg: bytes) -> bytes:
+    return b'Content-Type: image/jpeg\r\n\r\n' + frame_jpeg + b'\r\n--frame\r\n'
+
+
+def feed_gen(receiver: distributor.Receiver, options: FeedOptions, plane_consumers=None):
+    """
+    Video streaming generator function. plane_consumers (a ChangeProcessor) is told the plane is being
+    watched for as long as the feed runs, for planes it only keeps around while somebody is watching.
+    """
+    yield b'--frame\r\n'
+    if plane_consumers is not None:
+        plane_consumers.add_plane_consumer(options.plane)
+    try:
+        not_before = None
+        while True:
+            result = receiver.get_last_result(not_before=not_before, timeout=FEED_TIMEOUT)
+            if result is None:
+                logging.info("ending %s feed: no frames for %d s", options.plane, FEED_TIMEOUT)
+                break
+            try:
+                frame_jpeg = options.jpeg(result)
+            except jpeg_cache.EncodeError as e:
+                logging.warning("skipping a %s frame: %s", options.plane, e)
+                continue
+            if frame_jpeg is None:
+                # slot was reused before we got to it, processed before we registered, or nothing to show
+                continue
+            not_before = next_due(options)
+            yield mjpeg_part(frame_jpeg)
+    except distributor.SlowConsumerError as e:
+        logging.info("ending %s feed: %s", options.plane, e)
+    finally:
+        if plane_consumers is not None:
+            plane_consumers.remove_plane_consumer(options.plane)
+        receiver.close()
+
+
+def feed(image_distributor: distributor.Distributor, plane: str, quality: int, plane_consumers=None):
+    """
+    a Flask response streaming the plane to the client of the current request, 400 for bad query parameters.
+    plane_consumers is passed on to feed_gen.
+    """
+    try:
+        options = FeedOptions.from_args(request.args, plane, quality)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype='text/plain')
+    c = image_distributor.get_receiver()
+    logging.info("created %s", c)
+    return Response(feed_gen(c, options, plane_consumers), mimetype='multipart/x-mixed-replace; boundary=frame')
@@ -0,0 +1,164 @@
+import cv2
+import numpy as np
+
+import change_processor
+import pacing
+import pipeline
+import source_images_from_picamera2
+
+MAIN_SIZE = (1280, 720)
+LORES_SIZE = (320, 240)
+
+
+class CameraStopped(Exception):
+    pass
+
+
+class FakeRequest:
+    """a completed request: frame n of the lores and main streams, with motion in every fifth frame"""
+    def __init__(self, camera, n: int):
+        self.camera = camera
+        self.n = n
+        self.released = False
+
+    def make_array(self, name: str) -> np.ndarray:
+        assert not self.released, "make_array after release"
+        self.camera.made[name] += 1
+        if name == "lores":
+            width, height = self.camera.lores_size
+            frame = np.full((height, width, 3), 60, np.uint8)
+            if self.n % 5 == 4:
+                frame[height // 4:height // 2, width // 4:width // 2] = 255
+            # rows padded out to a stride, as libcamera does
+            return np.pad(cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420), ((0, 0), (0, 32)))
+        width, height = self.camera.main_size
+        return np.full((height, width, 3), self.n % 256, np.uint8)
+
+    def get_metadata(self) -> dict:
+        return {'SensorTimestamp': 0}
+
+    def release(self):
+        assert not self.released, "released twice"
+        self.released = True
+        self.camera.held.remove(self)
+
+
+class FakePicamera2:
+    """stands in for picamera2.Picamera2, stops after max_requests frames"""
+    def __init__(self, max_requests: int = None):
+        self.max_requests = max_requests
+        self.made = {'lores': 0, 'main': 0}
+        self.held = []
+        self.max_held = 0
+        self.requests = 0
+        self.captured = 0
+        self.closed = False
+
+    def create_video_configuration(self, main: dict = None, lores: dict = None, **kwargs):
+        self.main_size = main.get('size', MAIN_SIZE)
+        self.lores_size = lores['size']
+        return {'main': main, 'lores': lores, **kwargs}
+
+    def create_still_configuration(self, **kwargs):
+        self.main_size = kwargs.get('main', {}).get('size', MAIN_SIZE)
+        return kwargs
+
+    def configure(self, config: dict):
+        self.config = config
+
+    def start(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def capture_request(self, flush: bool = False) -> FakeRequest:
+        if self.max_requests is not None and self.requests >= self.max_requests:
+            raise CameraStopped()
+        self.requests += 1
+        request = FakeRequest(self, self.requests)
+        self.held.append(request)
+        self.max_held = max(self.max_held, len(self.held))
+        return request
+
+    def capture_array(self, name: str) -> np.ndarray:
+        self.captured += 1
+        width, height = self.main_size
+        return np.zeros((height, width, 3), np.uint8)
+
+
+def make_source(camera: FakePicamera2):
+    return source_images_from_picamera2.PiCamera2FrameSource(dual_stream=True, resolution=MAIN_SIZE,
+                                                             lores_resolution=LORES_SIZE, camera=camera)
+
+
+def make_change_processor(directory):
+    return change_processor.ChangeProcessor({}, {'directory': str(directory), 'pre_roll_frames': 2,
+                                                 'writer': {'workers': 0}})
+
+
+def test_configuration():
+    camera = FakePicamera2()
+    make_source(camera)
+    assert camera.config['main'] == {'size': MAIN_SIZE, 'format': 'RGB888'}
+    assert camera.config['lores'] == {'size': LORES_SIZE, 'format': 'YUV420'}
+
+
+def test_main_is_only_made_for_saved_frames(tmp_path):
+    camera = FakePicamera2()
+    cp = make_change_processor(tmp_path)
+    frames = make_source(camera).yield_opencv_image_frames()
+    results = []
+    for _ in range(12):
+        frame, info = next(frames)
+        assert frame.shape == (LORES_SIZE[1], LORES_SIZE[0], 3)
+        results.append(cp.process_frame(frame, info))
+        assert 'main' not in info
+    frames.close()
+
+    assert camera.closed
+    # only the request of the frame being processed is ever held
+    assert camera.max_held == 1 and camera.held == []
+    saved = [mrt for mrt in results if mrt.has_main and mrt._main.ready]
+    assert 0 < camera.made['main'] == len(saved) < len(results)
+    assert camera.captured == 0
+    for mrt in saved:
+        assert mrt.main.shape == (MAIN_SIZE[1], MAIN_SIZE[0], 3)
+
+
+def test_late_read_captures_again(tmp_path):
+    camera = FakePicamera2()
+    cp = make_change_processor(tmp_path)
+    frames = make_source(camera).yield_opencv_image_frames()
+    mrt = cp.process_frame(*next(frames))
+    next(frames)
+    assert not mrt._main.ready
+    assert mrt.main.shape == (MAIN_SIZE[1], MAIN_SIZE[0], 3)
+    assert mrt._main.captured_later and camera.captured == 1
+    frames.close()
+
+
+def test_main_consumer_gets_the_held_frame(tmp_path):
+    camera = FakePicamera2()
+    cp = make_change_processor(tmp_path)
+    cp.add_plane_consumer('main')
+    frames = make_source(camera).yield_opencv_image_frames()
+    mrt = cp.process_frame(*next(frames))
+    next(frames)
+    assert mrt._main.ready and not mrt._main.captured_later
+    assert mrt.get_jpeg('main')[:2] == b'\xff\xd8'
+    frames.close()
+
+
+def test_pipeline_holds_main_until_annotated(tmp_path):
+    camera = FakePicamera2(max_requests=40)
+    cp = make_change_processor(tmp_path)
+    staged = pipeline.Pipeline(make_source(camera), cp, pacing.FramePacer(0))
+    results = list(staged.results())
+
+    assert results
+    # the saved frames came from the requests detection ran on, not from later captures
+    assert camera.made['main'] > 0
+    assert camera.captured == 0
+    assert camera.held == []
+    assert camera.closed
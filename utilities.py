@@ -13,7 +13,7 @@ def make_pillow_from_cv2(cv2_image):
         # doing this saved about 4% on file size.
         pil_image = Image.fromarray(cv2_image)
 
-        if cv2_image.dtype == np.float64:
+        if np.issubdtype(cv2_image.dtype, np.floating):
             pil_image = pil_image.convert("L")
     else:
         # Convert from BGR to RGB
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import configuration
+# noinspection PyUnresolvedReferences
+import custom_logging
+
+import argparse
+import logging
+import sys
+import time
+
+from flask import Flask, jsonify, render_template
+
+import distributor
+import jpeg_cache
+import shm_ring
+import streaming
+
+configuration.configure()
+app = Flask(__name__)
+
+ring = None
+
+
+def source():
+    """results read back from the frame ring shm_publisher.py writes, waiting for it to show up"""
+    global ring
+    logger = logging.getLogger("source")
+    logger.setLevel(logging.INFO)
+    shm_args = configuration.settings.get('shm', {})
+    name = shm_args.get('name', 'jomo')
+    while ring is None:
+        try:
+            ring = shm_ring.FrameRing.attach(name)
+            logger.info("attached to frame ring '%s'", name)
+        except FileNotFoundError:
+            logger.info("waiting for frame ring '%s'", name)
+            time.sleep(1)
+    yield from ring.results(poll_interval=shm_args.get('poll_interval', 0.005))
+
+
+image_distributor = distributor.Distributor(source=source, timestamp=lambda result: result.timestamp,
+                                            start_background_immediately=False,
+                                            **configuration.settings.get('distributor', {}))
+
+
+@app.route('/')
+def index():
+    """Video streaming home page."""
+    return render_template('index.html')
+
+
+def feed(plane: str, quality: int):
+    return streaming.feed(image_distributor, plane, quality)
+
+
+@app.route('/video_feed')
+def video_feed():
+    """Video streaming route. Put this in the src attribute of an img tag."""
+    return feed('frame2', 95)
+
+
+@app.route('/diff_feed')
+def diff_feed():
+    """Video streaming route. Put this in the src attribute of an img tag."""
+    return feed('threshold_after_erode', 75)
+
+
+@app.route('/stats')
+def stats():
+    """counters for keeping an eye on this worker"""
+    return jsonify({
+        'distributor': image_distributor.stats(),
+        'ring': ring.stats() if ring is not None else None,
+        'jpeg_cache': jpeg_cache.stats(),
+    })
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(argv)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])